@@ -1,19 +1,57 @@
 from PyQt6.QtWidgets import QApplication, QWidget, QMainWindow, QGridLayout, QPushButton, QTextEdit, QCheckBox, QLabel, QSlider
 #import PyQt6.QtCore as QtCore
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, pyqtSignal, QTimer
 import vtk
 from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 import argparse
+import atexit
+import math
+import cProfile
+import json
 import sys
+import time
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
 from vtk_camera import save_camera, load_camera
+from volume_store import VolumeStore, STORE_EXTENSION
+from vti_io import read_vti
+from timestep_cache import TimestepCache
+from isosurface_cache import IsosurfaceCache
+from brick_index import BrickIndex
+from frame_writer import FrameWriter
+from stage_timer import timer
 import os
 
 NA_IMAGE_PATH = "images/NA_MAP_NO_BORDER_WHITE.png"
 HRRR_WIDTH = 1798
 HRRR_HEIGHT = 1058
 BLANK_IMAGE = "images/blank_img.png"
+BACKGROUND_COLOR = (249/255, 242/255, 237/255)
+PRESSURE_SCALE_FACTOR = 0.5
+# number of positions of the isovalue sliders between a volume's min and max value
+ISOVALUE_STEPS = 1000
+# distance between the samples along each ray of the volume rendered layers (grid cells)
+VOLUME_SAMPLE_DISTANCE = 1.0
+# the stats overlay measures the frame rate over the renders of the last FPS_WINDOW
+# seconds (at most FPS_FRAMES of them)
+FPS_WINDOW = 2.0
+FPS_FRAMES = 240
+
+# isosurface extraction filters that can be picked with --contour
+#   generic                - vtkContourFilter, works on any dataset, single threaded
+#   flying-edges           - vtkFlyingEdges3D, multithreaded through vtkSMPTools
+#   synchronized-templates - vtkSynchronizedTemplates3D
+#   marching-cubes         - vtkMarchingCubes, classic marching cubes with a point locator
+CONTOUR_BACKENDS = {
+  "generic": vtk.vtkContourFilter,
+  "flying-edges": vtk.vtkFlyingEdges3D,
+  "synchronized-templates": vtk.vtkSynchronizedTemplates3D,
+  "marching-cubes": vtk.vtkMarchingCubes,
+}
 
-frame_counter = 0
 default_cam = {"position": [671.46120300504, -2054.1340881372676, 1786.9861600854017], "focal_point": [833.3877526949775, -20.752970430237255, 379.0011417472582], "view_up": [-0.002320196264332275, 0.5694042877567462, 0.8220543618116307], "clipping_range": [2193.398106044568, 4488.309829557098], "angle": 30.0}
 
 def set_camera(cam):
@@ -26,20 +64,134 @@ def set_camera(cam):
     camera.SetViewAngle(cam['angle'])
   return camera
 
-def save_frame(window, log):
-  global frame_counter
-
-  file_name = "Screenshot" + str(frame_counter).zfill(5) + ".png"
-  image = vtk.vtkWindowToImageFilter()
-  image.SetInput(window)
-  png_writer = vtk.vtkPNGWriter()
-  png_writer.SetInputConnection(image.GetOutputPort())
-  png_writer.SetFileName(file_name)
-  window.Render()
-  png_writer.Write()
-  frame_counter += 1
-  print(file_name + " has been successfully exported")
-  log.insertPlainText('Exported {}\n'.format(file_name))
+def load_vti(file_name):
+  # float16/quantized volumes are turned back into float32 by read_vti
+  image_data = read_vti(file_name)
+
+  print(file_name)
+
+  return image_data
+
+class Timestep:
+  # calling it loads the timestep's vtkImageData, key identifies its contents
+  # (file path and modification time) for the isosurface cache, bricks holds its
+  # min/max brick index once it has been built, stage names it in the timings,
+  # shared is set when the loaded volume wraps a buffer that is reused by the next load
+  def __init__(self, load, key, stage="read", shared=False):
+    self.load = load
+    self.key = key
+    self.stage = stage
+    self.shared = shared
+    self.bricks = None
+
+  def __call__(self):
+    with timer.stage(self.stage):
+      return self.load()
+
+def crop_image(image_data, crop):
+  # the part of a volume inside crop = (x0, x1, y0, y1[, z0, z1]) in map
+  # coordinates (grid points), starting at index 0 with its origin moved so
+  # it stays in place against the map
+  extent = list(image_data.GetExtent())
+  origin = image_data.GetOrigin()
+  spacing = image_data.GetSpacing()
+  for axis in range(len(crop) // 2):
+    low, high = sorted(crop[2 * axis:2 * axis + 2])
+    extent[2 * axis] = max(extent[2 * axis], math.floor((low - origin[axis]) / spacing[axis]))
+    extent[2 * axis + 1] = min(extent[2 * axis + 1], math.ceil((high - origin[axis]) / spacing[axis]))
+    if extent[2 * axis] > extent[2 * axis + 1]:
+      raise ValueError(f"--crop {crop} is outside the volume")
+
+  with timer.stage("crop"):
+    voi = vtk.vtkExtractVOI()
+    voi.SetInputData(image_data)
+    voi.SetVOI(extent)
+    voi.Update()
+
+  cropped = vtk.vtkImageData()
+  cropped.SetDimensions([extent[2 * axis + 1] - extent[2 * axis] + 1 for axis in range(3)])
+  cropped.SetSpacing(spacing)
+  cropped.SetOrigin([origin[axis] + extent[2 * axis] * spacing[axis] for axis in range(3)])
+  cropped.GetPointData().ShallowCopy(voi.GetOutput().GetPointData())
+  return cropped
+
+def timestep_loaders(path, crop=None):
+  # a folder of .vti files (one per timestep) or a single volume store file,
+  # returns one Timestep per timestep, cropped to crop (see crop_image) if given
+  if path.endswith(STORE_EXTENSION):
+    store = VolumeStore(path)
+    stat = os.stat(path)
+    loaders = [Timestep(lambda index=index: store.image_data(index), f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{index}")
+               for index in range(len(store.labels)) if store.written[index]]
+  else:
+    loaders = []
+    for file in sorted(os.listdir(path)):
+      file_name = os.path.join(path, file)
+      stat = os.stat(file_name)
+      loaders.append(Timestep(lambda file_name=file_name: load_vti(file_name),
+                              f"{os.path.abspath(file_name)}:{stat.st_mtime_ns}:{stat.st_size}"))
+
+  if crop:
+    loaders = [Timestep(lambda load=loader.load: crop_image(load(), crop), f"{loader.key}|crop={tuple(crop)}")
+               for loader in loaders]
+  return loaders
+
+class VolumeInterpolator:
+  # linearly blends two neighbouring timesteps into one reused float32 buffer,
+  # keeping the last two volumes it read loaded. The returned volume wraps the
+  # buffer, so it is only valid until the next call.
+  def __init__(self, loaders):
+    self.loaders = loaders
+    self.loaded = {}
+    self.buffer = None
+    self.lock = threading.Lock()
+
+  def volume(self, index):
+    if index not in self.loaded:
+      if len(self.loaded) >= 2:
+        self.loaded.pop(max(self.loaded, key=lambda loaded: abs(loaded - index)))
+      image_data = self.loaders[index]()
+      self.loaded[index] = (image_data, vtk_to_numpy(image_data.GetPointData().GetScalars()))
+    return self.loaded[index]
+
+  def __call__(self, index, fraction):
+    with self.lock:
+      image_data, before = self.volume(index)
+      _, after = self.volume(index + 1)
+
+      if self.buffer is None or self.buffer.shape != before.shape:
+        self.buffer = np.empty(before.shape, dtype=np.float32)
+      # before + (after - before) * fraction, without temporary arrays
+      np.subtract(after, before, out=self.buffer)
+      np.multiply(self.buffer, np.float32(fraction), out=self.buffer)
+      np.add(self.buffer, before, out=self.buffer)
+
+      blended = vtk.vtkImageData()
+      blended.CopyStructure(image_data)
+      vtk_array = numpy_to_vtk(num_array=self.buffer, deep=False, array_type=vtk.VTK_FLOAT)
+      vtk_array.SetName(image_data.GetPointData().GetScalars().GetName())
+      blended.GetPointData().SetScalars(vtk_array)
+      return blended
+
+def tween_timesteps(loaders, substeps):
+  # substeps interpolated timesteps between each pair of hours, in order
+  interpolate = VolumeInterpolator(loaders)
+  tweens = []
+  for index in range(len(loaders) - 1):
+    for step in range(1, substeps + 1):
+      fraction = step / (substeps + 1)
+      tweens.append(Timestep(lambda index=index, fraction=fraction: interpolate(index, fraction),
+                             f"{loaders[index].key}|{loaders[index + 1].key}|{fraction!r}", "interpolate", True))
+  return tweens
+
+def animation_frames(num_timesteps, substeps):
+  # (hour, tween index or None) of every frame of the animation
+  frames = []
+  for hour in range(num_timesteps):
+    frames.append((hour, None))
+    if hour < num_timesteps - 1:
+      frames += [(hour, hour * substeps + step) for step in range(substeps)]
+  return frames
 
 def make_map_actor(image_path, height, width):
   reader = vtk.vtkPNGReader()
@@ -65,26 +217,60 @@ def make_map_actor(image_path, height, width):
 
   return actor
 
-def make_pressure_layer_actor(image_data, height_data, scale_factor):
-  # create height map representation of elevation with vtkWarpScalar
-  geometry_filter = vtk.vtkImageDataGeometryFilter()
-  geometry_filter.SetInputData(height_data)
-  geometry_filter.Update()
-
-  geometry_data = geometry_filter.GetOutput()
-
-  warp = vtk.vtkWarpScalar()
-  warp.SetInputData(geometry_data)
-  warp.SetScaleFactor(scale_factor)
-  warp.Update()
-
+class PressureMesh:
+  # the pressure layer's height map, built once as a single mesh. Every timestep has
+  # the same grid, so changing time only rewrites the z of its points (what
+  # vtkWarpScalar would give: origin z + heights * scale_factor), in place.
+  # With colored the heights are also kept as the mesh's scalars (--field layers are
+  # colored by value), a scale_factor of 0 leaves the mesh flat.
+  def __init__(self, height_data, scale_factor, colored=False):
+    with timer.stage("pressure geometry"):
+      geometry_filter = vtk.vtkImageDataGeometryFilter()
+      geometry_filter.SetInputData(height_data)
+      geometry_filter.Update()
+
+    self.polydata = geometry_filter.GetOutput()
+    # the heights are not drawn (the layer is textured), so they are not kept on the mesh
+    self.polydata.GetPointData().Initialize()
+    self.z = vtk_to_numpy(self.polydata.GetPoints().GetData())[:, 2]
+    self.base_z = height_data.GetOrigin()[2]
+    self.scale_factor = scale_factor
+    self.values = None
+    if colored:
+      self.values = np.zeros(self.z.size, dtype=np.float32)
+      scalars = numpy_to_vtk(num_array=self.values, deep=False, array_type=vtk.VTK_FLOAT)
+      scalars.SetName("values")
+      self.polydata.GetPointData().SetScalars(scalars)
+    self.shown = None
+
+  def show(self, heights):
+    # write a timestep's heights (from pressure_heights) into the mesh, returns the mesh
+    if heights is not self.shown:
+      if heights.size != self.z.size:
+        raise ValueError(f"Pressure layer timestep has {heights.size} points, the layer has {self.z.size}")
+      with timer.stage("pressure heights"):
+        np.multiply(heights, np.float32(self.scale_factor), out=self.z)
+        self.z += np.float32(self.base_z)
+        self.polydata.GetPoints().Modified()
+        if self.values is not None:
+          self.values[:] = heights
+          self.polydata.GetPointData().GetScalars().Modified()
+      self.shown = heights
+    return self.polydata
+
+def pressure_heights(timestep):
+  # the compact per-timestep part of the pressure layer, a float32 copy of its heights
+  height_data = timestep()
+  return vtk_to_numpy(height_data.GetPointData().GetScalars()).astype(np.float32)
+
+def make_pressure_layer_actor(image_data):
   # texture-map the blank image onto the height map geometry
   texture = vtk.vtkTexture()
   texture.SetInputData(image_data)
   texture.InterpolateOn()
 
+  # the shared PressureMesh is set as the mapper's input data
   mapper = vtk.vtkPolyDataMapper()
-  mapper.SetInputConnection(warp.GetOutputPort())
   mapper.ScalarVisibilityOff()
 
   actor = vtk.vtkActor()
@@ -93,14 +279,356 @@ def make_pressure_layer_actor(image_data, height_data, scale_factor):
 
   return actor
 
-def make_variable_contour_filters(image_data, isovalue):
-  contour_filter = vtk.vtkContourFilter()
+def make_field_actor(value_range):
+  # a --field layer, colored by value from blue (low) to red (high) over value_range,
+  # values below it are not drawn
+  lut = vtk.vtkLookupTable()
+  lut.SetHueRange(0.667, 0.0)
+  lut.SetTableRange(value_range)
+  lut.SetBelowRangeColor(0.0, 0.0, 0.0, 0.0)
+  lut.UseBelowRangeColorOn()
+  lut.Build()
+
+  # the shared PressureMesh (colored) is set as the mapper's input data
+  mapper = vtk.vtkPolyDataMapper()
+  mapper.SetLookupTable(lut)
+  mapper.SetScalarRange(value_range)
+  mapper.SetScalarModeToUsePointData()
+  mapper.ScalarVisibilityOn()
+  # hides exactly the parts below the range instead of fading the triangles around them
+  mapper.InterpolateScalarsBeforeMappingOn()
+
+  # z scaled like the contour and volume layers, so a level index lands on its level
+  actor = vtk.vtkActor()
+  actor.SetMapper(mapper)
+  actor.SetScale(1.0,1.0,5.0)
+  actor.GetProperty().SetOpacity(0.8)
+  return actor
+
+def field_range(image_data):
+  # color range of a --field layer (unless --field-range sets it), from its first timestep.
+  # Negative values (-1 where top_index/base_index have no level) are left below it
+  if args.field_range:
+    return tuple(args.field_range)
+  values = vtk_to_numpy(image_data.GetPointData().GetScalars())
+  values = values[values >= 0]
+  if values.size == 0:
+    return (0.0, 1.0)
+  low, high = float(values.min()), float(values.max())
+  return (low, high) if high > low else (low, low + 1.0)
+
+def make_variable_contour_filters(image_data, isovalue, backend="generic", compute_normals=True, merge_points=True):
+  contour_filter = CONTOUR_BACKENDS[backend]()
   contour_filter.SetInputData(image_data)
   contour_filter.SetValue(0, isovalue) 
+  contour_filter.SetComputeNormals(compute_normals)
+
+  # flying edges and synchronized templates always share points between triangles,
+  # vtkContourFilter hands image data to synchronized templates as well (ignoring
+  # its locator), so only marching cubes can skip merging to save time
+  if not merge_points and backend == "marching-cubes":
+    contour_filter.SetLocator(vtk.vtkNonMergingPointLocator())
   contour_filter.Update()
 
   return contour_filter
 
+def make_brick_contour_filters(image_data, bricks, isovalue, backend="generic", compute_normals=True, merge_points=True):
+  # contour only the extents of the bricks whose value range contains the isovalue
+  append = vtk.vtkAppendPolyData()
+  for extent in bricks.extents(isovalue):
+    voi = vtk.vtkExtractVOI()
+    voi.SetInputData(image_data)
+    voi.SetVOI(*extent)
+    voi.Update()
+    contour_filter = make_variable_contour_filters(voi.GetOutput(), isovalue, backend, compute_normals, merge_points)
+    append.AddInputData(contour_filter.GetOutput())
+
+  if append.GetNumberOfInputConnections(0) == 0:
+    append.AddInputData(vtk.vtkPolyData())
+  append.Update()
+
+  return append
+
+def make_lod(polydata, reduction, lod_filter="clustering"):
+  # decimated copy of a surface with about `reduction` of its triangles removed
+  if polydata.GetNumberOfPolys() == 0:
+    return polydata
+
+  if lod_filter == "decimation":
+    # contour output has duplicate points along cell faces, which quadric
+    # decimation can't collapse, so they are merged first
+    clean = vtk.vtkCleanPolyData()
+    clean.SetInputData(polydata)
+    decimate = vtk.vtkQuadricDecimation()
+    decimate.SetInputConnection(clean.GetOutputPort())
+    decimate.SetTargetReduction(reduction)
+  else:
+    # quadric clustering is much faster, its bins are sized (in grid cells) for the
+    # reduction, keeping one bin per pressure level since there are only a few
+    x0, x1, y0, y1, z0, z1 = polydata.GetBounds()
+    size = (1.0 - reduction) ** (-1 / 1.5)
+    decimate = vtk.vtkQuadricClustering()
+    decimate.AutoAdjustNumberOfDivisionsOff()
+    decimate.SetInputData(polydata)
+    decimate.SetNumberOfDivisions(max(1, int((x1 - x0) / size)), max(1, int((y1 - y0) / size)), max(1, math.ceil(z1 - z0) + 1))
+  decimate.Update()
+  lod = decimate.GetOutput()
+
+  # the isosurface scalars (all equal to the isovalue) keep the mesh coloured like the full one
+  scalars = polydata.GetPointData().GetScalars()
+  if scalars is not None:
+    values = vtk.vtkFloatArray()
+    values.SetName(scalars.GetName())
+    values.SetNumberOfTuples(lod.GetNumberOfPoints())
+    values.Fill(scalars.GetTuple1(0))
+    lod.GetPointData().SetScalars(values)
+  return lod
+
+def make_contour_actor():
+  # the isosurface of the current timestep is set as the mapper's input data
+  mapper = vtk.vtkPolyDataMapper()
+  mapper.ScalarVisibilityOn()
+
+  actor = vtk.vtkActor()
+  actor.SetMapper(mapper)
+  actor.SetScale(1.0,1.0,5.0)
+
+  return actor
+
+def make_volume_actor(threads=0):
+  # CPU ray casting (no GPU needed), multithreaded, the volume of the current
+  # timestep is set as the mapper's input data
+  mapper = vtk.vtkFixedPointVolumeRayCastMapper()
+  mapper.AutoAdjustSampleDistancesOff()
+  mapper.SetSampleDistance(VOLUME_SAMPLE_DISTANCE)
+  if threads:
+    mapper.SetNumberOfThreads(threads)
+
+  volume_property = vtk.vtkVolumeProperty()
+  volume_property.SetInterpolationTypeToLinear()
+  volume_property.ShadeOff()
+
+  volume = vtk.vtkVolume()
+  volume.SetMapper(mapper)
+  volume.SetProperty(volume_property)
+  volume.SetScale(1.0,1.0,5.0)
+
+  return volume
+
+def load_transfer_functions(file_name):
+  # {layer: {"color": [[value, r, g, b], ...], "opacity": [[value, opacity], ...]}}
+  # from the --transfer-function file, layers left out use the default
+  if not file_name:
+    return {}
+  with open(file_name) as tf_file:
+    return json.load(tf_file)
+
+def set_transfer_function(volume, isovalue, value_range, spec=None):
+  # without a spec, values below the isovalue are transparent and the opacity and
+  # color ramp up from there to the top of the value range
+  color = vtk.vtkColorTransferFunction()
+  opacity = vtk.vtkPiecewiseFunction()
+  if spec is None:
+    high = max(value_range[1], isovalue)
+    opacity.AddPoint(value_range[0], 0.0)
+    opacity.AddPoint(isovalue, 0.0)
+    opacity.AddPoint(high, 0.5)
+    color.AddHSVPoint(isovalue, 0.6667, 1.0, 1.0)
+    color.AddHSVPoint(high, 0.0, 1.0, 1.0)
+  else:
+    for value, red, green, blue in spec["color"]:
+      color.AddRGBPoint(value, red, green, blue)
+    for value, alpha in spec["opacity"]:
+      opacity.AddPoint(value, alpha)
+
+  volume.GetProperty().SetColor(color)
+  volume.GetProperty().SetScalarOpacity(opacity)
+
+def set_volume_detail(volume, reduction):
+  # cast fewer rays (image sample distance) with fewer samples along each one
+  # while the camera moves, reduction 1 is full detail
+  mapper = volume.GetMapper()
+  mapper.SetImageSampleDistance(reduction)
+  mapper.SetSampleDistance(VOLUME_SAMPLE_DISTANCE * reduction)
+
+def make_scene_actors(volume_layers=(), threads=0):
+  # map, folder1/folder2 isosurfaces (or volumes for the layers in volume_layers)
+  # and pressure layer, used by the window and --headless
+  map_actor = make_map_actor(NA_IMAGE_PATH, HRRR_HEIGHT, HRRR_WIDTH)
+  x, y, z = map_actor.GetPosition()
+  map_actor.SetPosition(x, y, z - 100.0)
+
+  folder1_actor = make_volume_actor(threads) if "folder1" in volume_layers else make_contour_actor()
+  if "folder2" in volume_layers:
+    folder2_actor = make_volume_actor(threads)
+  else:
+    folder2_actor = make_contour_actor()
+    folder2_actor.GetProperty().SetOpacity(0.5)
+
+  # Read the image
+  image_reader = vtk.vtkPNGReader()
+  image_reader.SetFileName(BLANK_IMAGE)
+  image_reader.Update()
+
+  folder3_actor = make_pressure_layer_actor(image_reader.GetOutput())
+  x, y, z = folder3_actor.GetPosition()
+  folder3_actor.SetPosition(x, y, z - 100.0)
+  folder3_actor.GetProperty().SetOpacity(0.8)
+
+  return map_actor, folder1_actor, folder2_actor, folder3_actor
+
+def contour_timestep(timestep, isovalue, contour_options, surface_cache=None, brick_size=0):
+  if surface_cache is not None:
+    with timer.stage("surface cache read"):
+      polydata = surface_cache.load(timestep.key, isovalue, contour_options)
+    if polydata is not None:
+      return polydata
+
+  image_data = timestep()
+  if brick_size > 0:
+    # built on first load, then reused for every isovalue
+    if timestep.bricks is None:
+      with timer.stage("brick index"):
+        timestep.bricks = BrickIndex(image_data, brick_size)
+    with timer.stage("contour"):
+      polydata = make_brick_contour_filters(image_data, timestep.bricks, isovalue, **contour_options).GetOutput()
+  else:
+    with timer.stage("contour"):
+      polydata = make_variable_contour_filters(image_data, isovalue, **contour_options).GetOutput()
+
+  if surface_cache is not None:
+    with timer.stage("surface cache write"):
+      surface_cache.save(timestep.key, isovalue, contour_options, polydata)
+  return polydata
+
+def timestep_lod(timestep, isovalue, polydata, contour_options, surface_cache=None, reduction=0.9, lod_filter="clustering"):
+  # the decimated surface is cached next to the full one, under the LOD settings
+  options = {**contour_options, "lod_reduction": reduction, "lod_filter": lod_filter}
+  if surface_cache is not None:
+    with timer.stage("surface cache read"):
+      lod = surface_cache.load(timestep.key, isovalue, options)
+    if lod is not None:
+      return lod
+
+  with timer.stage("lod"):
+    lod = make_lod(polydata, reduction, lod_filter)
+
+  if surface_cache is not None:
+    with timer.stage("surface cache write"):
+      surface_cache.save(timestep.key, isovalue, options, lod)
+  return lod
+
+def contour_options_from_args(args):
+  return {
+    "backend": args.contour,
+    "compute_normals": not args.no_normals,
+    "merge_points": not args.no_merge,
+  }
+
+def surface_cache_from_args(args):
+  # isosurfaces from earlier runs are loaded from disk instead of recomputed
+  if args.surface_cache_mb > 0:
+    return IsosurfaceCache(args.surface_cache, args.surface_cache_mb * 1024 * 1024)
+  return None
+
+class Surface:
+  # a layer's mesh for one timestep, with a low detail version (or None) shown
+  # while the camera moves
+  def __init__(self, full, lod=None):
+    self.full = full
+    self.lod = lod
+
+  def mesh(self, low_detail):
+    if low_detail and self.lod is not None:
+      return self.lod
+    return self.full
+
+class PressureSurface:
+  # one timestep of the pressure layer: its heights, shown on the shared PressureMesh
+  def __init__(self, pressure_mesh, heights):
+    self.pressure_mesh = pressure_mesh
+    self.heights = heights
+
+  def mesh(self, low_detail):
+    return self.pressure_mesh.show(self.heights)
+
+def pressure_surface_bytes(surface):
+  return surface.heights.nbytes
+
+class VolumeSurface:
+  # one timestep of a volume rendered layer: its scalars, swapped into the layer's
+  # one vtkImageData when it is shown, no geometry is extracted
+  def __init__(self, volume_data, scalars):
+    self.volume_data = volume_data
+    self.scalars = scalars
+
+  def mesh(self, low_detail):
+    point_data = self.volume_data.GetPointData()
+    if point_data.GetScalars() is not self.scalars:
+      if self.scalars.GetNumberOfTuples() != self.volume_data.GetNumberOfPoints():
+        raise ValueError(f"Timestep has {self.scalars.GetNumberOfTuples()} points, the volume has {self.volume_data.GetNumberOfPoints()}")
+      point_data.SetScalars(self.scalars)
+    return self.volume_data
+
+def volume_structure(image_data):
+  # empty vtkImageData with the grid of image_data, a volume rendered layer's timesteps are swapped into it
+  volume_data = vtk.vtkImageData()
+  volume_data.CopyStructure(image_data)
+  return volume_data
+
+def volume_scalars(timestep):
+  scalars = timestep().GetPointData().GetScalars()
+  # an interpolated volume's buffer is overwritten by the next one
+  if timestep.shared:
+    copy = scalars.NewInstance()
+    copy.DeepCopy(scalars)
+    scalars = copy
+  return scalars
+
+def volume_surface_bytes(surface):
+  return surface.scalars.GetActualMemorySize() * 1024
+
+def layer_surface_bytes(surface):
+  if isinstance(surface, VolumeSurface):
+    return volume_surface_bytes(surface)
+  return surface_bytes(surface)
+
+def surface_bytes(surface):
+  size = surface.full.GetActualMemorySize()
+  if surface.lod is not None:
+    size += surface.lod.GetActualMemorySize()
+  return size * 1024
+
+def stats_text(stats, fps=None):
+  # fps is the number of frames actually drawn per second, render/s how many
+  # renders per second the mean render time would allow
+  lines = [f"{'stage':<20}{'runs':>6}{'mean ms':>9}{'p95 ms':>9}{'max ms':>9}"]
+  for name, (runs, mean, p95, peak) in sorted(stats.items()):
+    lines.append(f"{name:<20}{runs:>6}{mean * 1e3:>9.1f}{p95 * 1e3:>9.1f}{peak * 1e3:>9.1f}")
+  rates = []
+  if fps is not None:
+    rates.append(f"{fps:.1f} fps")
+  if "render" in stats:
+    rates.append(f"{1 / stats['render'][1]:.1f} render/s")
+  if rates:
+    lines.append(", ".join(rates))
+  return "\n".join(lines)
+
+def isovalue_range(image_data, isovalue):
+  # the isovalue sliders cover the first timestep's values (and the starting isovalue)
+  low, high = image_data.GetScalarRange()
+  return min(low, isovalue), max(high, isovalue)
+
+def slider_to_isovalue(value_range, position):
+  low, high = value_range
+  return low + (high - low) * position / ISOVALUE_STEPS
+
+def isovalue_to_slider(value_range, isovalue):
+  low, high = value_range
+  if high == low:
+    return 0
+  return round((isovalue - low) / (high - low) * ISOVALUE_STEPS)
+
 
 class Ui_MainWindow(object):
   def setupUi(self, MainWindow):
@@ -127,19 +655,33 @@ class Ui_MainWindow(object):
     # Isovalue slider
     self.time_label = QLabel("Time:")
     self.folder1_time_slider = QSlider()
+    # animation play/pause button
+    self.push_play = QPushButton()
+    self.push_play.setText('Play')
+
+    # isovalue sliders
+    self.iso1_label = QLabel("Folder 1 isovalue:")
+    self.folder1_iso_slider = QSlider()
+    self.iso2_label = QLabel("Folder 2 isovalue:")
+    self.folder2_iso_slider = QSlider()
 
     # plane boxes and labels
     self.p1_label = QLabel("Folder 1:")
     self.p2_label = QLabel("Folder 2:")
     self.p3_label = QLabel("Pressure Surface:")
+    self.p4_label = QLabel("Derived Field:")
     self.map_label = QLabel("Map:")
+    self.stats_label = QLabel("Stats:")
     self.p1_check = QCheckBox()
     self.p2_check = QCheckBox()
     self.p3_check = QCheckBox()
+    self.p4_check = QCheckBox()
     self.map_check = QCheckBox()
+    self.stats_check = QCheckBox()
     self.p1_check.setChecked(True)
     self.p2_check.setChecked(True)
     self.p3_check.setChecked(True)
+    self.p4_check.setChecked(True)
     self.map_check.setChecked(True)
 
     # subwidget and grid to put boxes in
@@ -156,17 +698,26 @@ class Ui_MainWindow(object):
     self.subgrid.addWidget(self.p2_check, 0, 3, 1, 1)
     self.subgrid.addWidget(self.p3_label, 0, 4, 1, 1)
     self.subgrid.addWidget(self.p3_check, 0, 5, 1, 1)
-    self.subgrid.addWidget(self.map_label, 0, 6, 1, 1)
-    self.subgrid.addWidget(self.map_check, 0, 7, 1, 1)
+    self.subgrid.addWidget(self.p4_label, 0, 6, 1, 1)
+    self.subgrid.addWidget(self.p4_check, 0, 7, 1, 1)
+    self.subgrid.addWidget(self.map_label, 0, 8, 1, 1)
+    self.subgrid.addWidget(self.map_check, 0, 9, 1, 1)
+    self.subgrid.addWidget(self.stats_label, 0, 10, 1, 1)
+    self.subgrid.addWidget(self.stats_check, 0, 11, 1, 1)
 
     self.gridlayout.addWidget(self.vtkWidget, 0, 0, 5, 5)
     self.gridlayout.addWidget(self.log, 2, 6, 1, 1)
     self.gridlayout.addWidget(self.push_quit, 4, 6, 1, 1)
     self.gridlayout.addWidget(self.time_label, 5, 0, 1, 3)
     self.gridlayout.addWidget(self.folder1_time_slider, 5, 1, 1, 3)
+    self.gridlayout.addWidget(self.push_play, 5, 4, 1, 1)
     self.gridlayout.addWidget(self.push_screenshot, 0, 6, 1, 1)
     self.gridlayout.addWidget(self.push_camera, 1, 6, 1, 1)
     self.gridlayout.addWidget(self.subwidget, 6, 0, 1, 2)
+    self.gridlayout.addWidget(self.iso1_label, 7, 0, 1, 1)
+    self.gridlayout.addWidget(self.folder1_iso_slider, 7, 1, 1, 3)
+    self.gridlayout.addWidget(self.iso2_label, 8, 0, 1, 1)
+    self.gridlayout.addWidget(self.folder2_iso_slider, 8, 1, 1, 3)
 
     self.gridlayout.setColumnStretch(2, 5)  # stretch slider column
     self.gridlayout.setColumnStretch(6, 1)  # relative to log and buttons
@@ -174,123 +725,181 @@ class Ui_MainWindow(object):
     MainWindow.setCentralWidget(self.centralWidget)
 
 class IsoVis(QMainWindow):
+  # (layer, interpolated, timestep, surface) sent from the cache worker threads to the GUI thread
+  surface_ready = pyqtSignal(str, bool, int, object)
+  # (layer, interpolated, timestep, error message) of a surface that could not be computed
+  surface_failed = pyqtSignal(str, bool, int, str)
+  # file name of a screenshot written by the frame writer's background threads
+  screenshot_saved = pyqtSignal(str)
+
   def __init__(self, parent = None):
     QMainWindow.__init__(self, parent)
     self.ui = Ui_MainWindow()
     self.ui.setupUi(self)
+    self.surface_ready.connect(self.surface_ready_callback)
+    self.surface_failed.connect(self.surface_failed_callback)
+    self.screenshot_saved.connect(self.screenshot_saved_callback)
+
+    # screenshots are compressed and written off the GUI thread
+    self.frame_writer = FrameWriter(on_saved=self.screenshot_saved.emit)
 
     self.ren = vtk.vtkRenderer()
 
     self.current_time = 0
+    self.current_frame = 0
 
-    # === load map image ===
-    self.map_actor = make_map_actor(NA_IMAGE_PATH, HRRR_HEIGHT, HRRR_WIDTH)
-    x, y, z = self.map_actor.GetPosition()
-    self.map_actor.SetPosition(x, y, z - 100.0)
+    # === load map image, create the layer actors ===
+    self.map_actor, self.folder1_actor, self.folder2_actor, self.folder3_actor = make_scene_actors(args.volume, args.threads)
     self.ren.AddActor(self.map_actor)
 
-    self.scale_factor = 0.5
+    self.contour_options = contour_options_from_args(args)
+    self.surface_cache = surface_cache_from_args(args)
 
-    self.isovalue1 = float(args.folder1[1])
-    self.folder1_actors = []
-    self.folder1_contour_filters = []
+    # Timesteps are only read and contoured when they are first shown, then kept
+    # in an LRU cache (the budget is split between the layers) while the
+    # neighbouring timesteps are prefetched in the background. Surfaces are computed
+    # on the caches' worker threads and handed to the GUI thread by surface_ready.
+    # Each layer has a second cache for the frames interpolated between hours
+    # during playback, with its own budget (--tween-cache-mb) so they don't evict
+    # the hours around the current one.
+    num_layers = 4 if args.field else 3
+    cache_bytes = args.cache_mb * 1024 * 1024 // num_layers
+    tween_bytes = args.tween_cache_mb * 1024 * 1024 // num_layers
 
-    var_folder_path = args.folder1[0]
-    filenames1 = os.listdir(var_folder_path)
+    # layers shown by volume rendering (--volume) keep one vtkImageData with the grid
+    # of their first timestep, their caches only hold each timestep's scalars
+    self.volume_data = {}
 
-    # ==== TEMPERATURE CONTOUR ====
-    for file in filenames1:
-      # === Read VTI file ===
-      reader = vtk.vtkXMLImageDataReader()
-      reader.SetFileName(os.path.join(var_folder_path, file))
-      reader.Update()
-
-      print(os.path.join(var_folder_path, file))
-
-      image_data = reader.GetOutput()
-
-      new_contour_filter = make_variable_contour_filters(image_data, self.isovalue1)
-      self.folder1_contour_filters.append(new_contour_filter)
-    
-      # === Mapper and Actor ===
-      mapper = vtk.vtkPolyDataMapper()
-      mapper.SetInputConnection(new_contour_filter.GetOutputPort())
-      mapper.ScalarVisibilityOn()
+    self.isovalue1 = float(args.folder1[1])
+    self.folder1_loaders = timestep_loaders(args.folder1[0], args.crop)
+    first_volume = self.folder1_loaders[0]()
+    self.folder1_range = isovalue_range(first_volume, self.isovalue1)
+    if "folder1" in args.volume:
+      self.volume_data["folder1"] = volume_structure(first_volume)
 
-      temp_actor = vtk.vtkActor()
-      temp_actor.SetMapper(mapper)
+    # ==== TEMPERATURE CONTOUR ====
+    def contour_folder1(index):
+      return self.layer_surface("folder1", self.folder1_loaders[index], self.isovalue1)
 
-      temp_actor.SetScale(1.0,1.0,5.0)
+    self.folder1_cache = TimestepCache(len(self.folder1_loaders), contour_folder1, layer_surface_bytes,
+                                       cache_bytes, args.prefetch,
+                                       **self.cache_callbacks("folder1", False))
 
-      self.folder1_actors.append(temp_actor)
+    self.folder1_tweens = tween_timesteps(self.folder1_loaders, args.substeps)
+    self.folder1_tween_cache = TimestepCache(len(self.folder1_tweens), lambda index: self.layer_surface("folder1", self.folder1_tweens[index], self.isovalue1),
+                                             layer_surface_bytes, tween_bytes, args.prefetch,
+                                             **self.cache_callbacks("folder1", True))
 
     self.isovalue2 = float(args.folder2[1])
-    self.folder2_actors = []
-    self.folder2_contour_filters = []
-
-    var_folder2_path = args.folder2[0]
-    filenames2 = os.listdir(var_folder2_path)
+    self.folder2_loaders = timestep_loaders(args.folder2[0], args.crop)
+    first_volume = self.folder2_loaders[0]()
+    self.folder2_range = isovalue_range(first_volume, self.isovalue2)
+    if "folder2" in args.volume:
+      self.volume_data["folder2"] = volume_structure(first_volume)
 
     # ==== TEMPERATURE CONTOUR ====
-    for file in filenames2:
-      # === Read VTI file ===
-      reader = vtk.vtkXMLImageDataReader()
-      reader.SetFileName(os.path.join(var_folder2_path, file))
-      reader.Update()
-
-      print(os.path.join(var_folder2_path, file))
-
-      image_data = reader.GetOutput()
-
-      new_contour_filter = make_variable_contour_filters(image_data, self.isovalue2)
-      self.folder2_contour_filters.append(new_contour_filter)
-    
-      # === Mapper and Actor ===
-      mapper = vtk.vtkPolyDataMapper()
-      mapper.SetInputConnection(new_contour_filter.GetOutputPort())
-      mapper.ScalarVisibilityOn()
-
-      temp_actor = vtk.vtkActor()
-      temp_actor.SetMapper(mapper)
-
-      temp_actor.SetScale(1.0,1.0,5.0)
-      temp_actor.GetProperty().SetOpacity(0.5)
-
-      self.folder2_actors.append(temp_actor)
+    def contour_folder2(index):
+      return self.layer_surface("folder2", self.folder2_loaders[index], self.isovalue2)
 
+    self.folder2_cache = TimestepCache(len(self.folder2_loaders), contour_folder2, layer_surface_bytes,
+                                       cache_bytes, args.prefetch,
+                                       **self.cache_callbacks("folder2", False))
 
-    self.folder3_actors = []
+    self.folder2_tweens = tween_timesteps(self.folder2_loaders, args.substeps)
+    self.folder2_tween_cache = TimestepCache(len(self.folder2_tweens), lambda index: self.layer_surface("folder2", self.folder2_tweens[index], self.isovalue2),
+                                             layer_surface_bytes, tween_bytes, args.prefetch,
+                                             **self.cache_callbacks("folder2", True))
 
-    var_folder3_path = args.pressure
-    filenames3 = os.listdir(var_folder3_path)
+    # the pressure layer is 2D, so only the x/y part of --crop applies to it
+    self.folder3_loaders = timestep_loaders(args.pressure, args.crop and args.crop[:4])
 
-    for file in filenames3:
-      # Read the image
-      image_reader = vtk.vtkPNGReader()
-      image_reader.SetFileName(BLANK_IMAGE)
-      image_reader.Update()
+    # the pressure layer is one mesh built from the first timestep, the caches only
+    # hold each timestep's heights, which are written into it when it is shown
+    self.pressure_mesh = PressureMesh(self.folder3_loaders[0](), PRESSURE_SCALE_FACTOR)
 
-      image_data = image_reader.GetOutput()
+    def pressure_surface(index):
       # Read the height map
-      height_reader = vtk.vtkXMLImageDataReader()
-      height_reader.SetFileName(os.path.join(var_folder3_path, file))
-      height_reader.Update()
-
-      print(os.path.join(var_folder3_path, file))
-
-      heights = height_reader.GetOutput()
-
-      actor = make_pressure_layer_actor(image_data, heights, self.scale_factor)
-      x, y, z = actor.GetPosition()
-      actor.SetPosition(x, y, z - 100.0)
-      actor.GetProperty().SetOpacity(0.8)
-      self.folder3_actors.append(actor)
-
-    self.ren.SetBackground(249/255, 242/255, 237/255) 
+      return PressureSurface(self.pressure_mesh, pressure_heights(self.folder3_loaders[index]))
+
+    self.folder3_cache = TimestepCache(len(self.folder3_loaders), pressure_surface, pressure_surface_bytes,
+                                       cache_bytes, args.prefetch,
+                                       **self.cache_callbacks("folder3", False))
+
+    self.folder3_tweens = tween_timesteps(self.folder3_loaders, args.substeps)
+    self.folder3_tween_cache = TimestepCache(len(self.folder3_tweens), lambda index: PressureSurface(self.pressure_mesh, pressure_heights(self.folder3_tweens[index])),
+                                             pressure_surface_bytes, tween_bytes, args.prefetch,
+                                             **self.cache_callbacks("folder3", True))
+
+    # actor, checkbox, cache of the hours and cache of the interpolated frames of each layer
+    self.layers = {
+      "folder1": (self.folder1_actor, self.ui.p1_check, self.folder1_cache, self.folder1_tween_cache),
+      "folder2": (self.folder2_actor, self.ui.p2_check, self.folder2_cache, self.folder2_tween_cache),
+      "folder3": (self.folder3_actor, self.ui.p3_check, self.folder3_cache, self.folder3_tween_cache),
+    }
+
+    # the optional --field layer (a 2D derived field), shown like the pressure layer
+    # but colored by its values
+    self.ui.p4_label.setVisible(bool(args.field))
+    self.ui.p4_check.setVisible(bool(args.field))
+    if args.field:
+      self.field_loaders = timestep_loaders(args.field, args.crop and args.crop[:4])
+      first_field = self.field_loaders[0]()
+      self.field_mesh = PressureMesh(first_field, args.field_scale, colored=True)
+      self.field_actor = make_field_actor(field_range(first_field))
+
+      self.field_cache = TimestepCache(len(self.field_loaders), lambda index: PressureSurface(self.field_mesh, pressure_heights(self.field_loaders[index])),
+                                       pressure_surface_bytes, cache_bytes, args.prefetch,
+                                       **self.cache_callbacks("folder4", False))
+
+      self.field_tweens = tween_timesteps(self.field_loaders, args.substeps)
+      self.field_tween_cache = TimestepCache(len(self.field_tweens), lambda index: PressureSurface(self.field_mesh, pressure_heights(self.field_tweens[index])),
+                                             pressure_surface_bytes, tween_bytes, args.prefetch,
+                                             **self.cache_callbacks("folder4", True))
+      self.layers["folder4"] = (self.field_actor, self.ui.p4_check, self.field_cache, self.field_tween_cache)
+
+    # the isovalue sliders of volume rendered layers move their transfer function
+    # (unless --transfer-function sets it), which is read again whenever the file
+    # changes so it can be edited while the viewer runs
+    self.transfer_functions = load_transfer_functions(args.transfer_function)
+    for layer in args.volume:
+      self.apply_transfer_function(layer)
+    if args.transfer_function:
+      self.transfer_function_mtime = os.stat(args.transfer_function).st_mtime_ns
+      self.transfer_function_timer = QTimer(self)
+      self.transfer_function_timer.setInterval(1000)
+      self.transfer_function_timer.timeout.connect(self.transfer_function_callback)
+      self.transfer_function_timer.start()
+
+    # playback steps through the hours and the frames interpolated between them
+    self.frames = animation_frames(len(self.folder1_loaders), args.substeps)
+    self.play_timer = QTimer(self)
+    self.play_timer.setInterval(round(1000 / args.fps))
+    self.play_timer.timeout.connect(self.play_step)
+
+    # stage timings overlay (Stats checkbox), every render is timed through the
+    # renderer's start/end events, including the ones during camera interaction
+    self.stats_actor = vtk.vtkTextActor()
+    self.stats_actor.GetTextProperty().SetFontFamilyToCourier()
+    self.stats_actor.GetTextProperty().SetFontSize(14)
+    self.stats_actor.GetTextProperty().SetColor(0.0, 0.0, 0.0)
+    self.stats_actor.SetPosition(10, 10)
+    self.render_start = None
+    # end times of the recent renders, the frame rate is measured between them
+    self.render_ends = deque(maxlen=FPS_FRAMES)
+    self.ren.AddObserver("StartEvent", self.render_start_callback)
+    self.ren.AddObserver("EndEvent", self.render_end_callback)
+
+    self.ren.SetBackground(BACKGROUND_COLOR)
     #self.ren.SetUseDepthPeeling(True) # enable depth peeling to properly visualize overlapping transparent meshes
     self.ui.vtkWidget.GetRenderWindow().AddRenderer(self.ren)
     self.iren = self.ui.vtkWidget.GetRenderWindow().GetInteractor()
 
+    # the isosurfaces switch to their low detail meshes while the camera moves
+    self.interacting = False
+    self.shown_surfaces = {}
+    self.iren.AddObserver("StartInteractionEvent", self.interaction_callback)
+    self.iren.AddObserver("EndInteractionEvent", self.interaction_callback)
+
     # set camera position (if camera arg specified)
     if args.camera:
       new_camera = load_camera(args.camera)
@@ -312,47 +921,239 @@ class IsoVis(QMainWindow):
     # Setting up widgets
     def slider_setup(slider, val, bounds, interv):
       slider.setOrientation(Qt.Orientation.Horizontal)
+      slider.setRange(bounds[0], bounds[1])
       slider.setValue(int(val))
       slider.setTracking(False)
       slider.setTickInterval(interv)
       slider.setTickPosition(QSlider.TickPosition.TicksAbove)
-      slider.setRange(bounds[0], bounds[1])
 
-    slider_setup(self.ui.folder1_time_slider, self.current_time, [0, len(self.folder1_actors) - 1], 1)
+    slider_setup(self.ui.folder1_time_slider, self.current_time, [0, len(self.folder1_cache) - 1], 1)
+
+    slider_setup(self.ui.folder1_iso_slider, isovalue_to_slider(self.folder1_range, self.isovalue1),
+                 [0, ISOVALUE_STEPS], ISOVALUE_STEPS // 10)
+    slider_setup(self.ui.folder2_iso_slider, isovalue_to_slider(self.folder2_range, self.isovalue2),
+                 [0, ISOVALUE_STEPS], ISOVALUE_STEPS // 10)
+    self.ui.iso1_label.setText(f"Folder 1 isovalue: {self.isovalue1:.4g}")
+    self.ui.iso2_label.setText(f"Folder 2 isovalue: {self.isovalue2:.4g}")
+
     self.slider_callback(self.current_time)
 
   def screenshot_callback(self):
-    save_frame(self.ui.vtkWidget.GetRenderWindow(), self.ui.log)
+    file_name = self.frame_writer.capture(self.ui.vtkWidget.GetRenderWindow(), args.screenshot_scale)
+    self.ui.log.insertPlainText('Saving {}\n'.format(file_name))
+
+  def screenshot_saved_callback(self, file_name):
+    print(file_name + " has been successfully exported")
+    self.ui.log.insertPlainText('Exported {}\n'.format(file_name))
 
   def save_camera_callback(self):
     save_camera(self.ren.GetActiveCamera(), self.ren)
     self.ui.log.insertPlainText('Camera position saved\n')
 
   def quit_callback(self):
+    # finish writing any screenshots still in the queue
+    self.frame_writer.close()
     sys.exit()
   
+  def contour_timestep(self, timestep, isovalue):
+    polydata = contour_timestep(timestep, isovalue, self.contour_options, self.surface_cache, args.bricks)
+    lod = None
+    if args.lod_reduction > 0:
+      lod = timestep_lod(timestep, isovalue, polydata, self.contour_options, self.surface_cache,
+                         args.lod_reduction, args.lod_filter)
+    return Surface(polydata, lod)
+
+  def layer_surface(self, layer, timestep, isovalue):
+    # volume rendered layers show the timestep's values as they are, the others its isosurface
+    if layer in self.volume_data:
+      return VolumeSurface(self.volume_data[layer], volume_scalars(timestep))
+    return self.contour_timestep(timestep, isovalue)
+
+  def apply_transfer_function(self, layer):
+    isovalue, value_range = {"folder1": (self.isovalue1, self.folder1_range),
+                             "folder2": (self.isovalue2, self.folder2_range)}[layer]
+    set_transfer_function(self.layers[layer][0], isovalue, value_range, self.transfer_functions.get(layer))
+
+  def transfer_function_callback(self):
+    # reload the --transfer-function file if it was saved since it was last read
+    try:
+      mtime = os.stat(args.transfer_function).st_mtime_ns
+      if mtime == self.transfer_function_mtime:
+        return
+      self.transfer_function_mtime = mtime
+      self.transfer_functions = load_transfer_functions(args.transfer_function)
+      for layer in args.volume:
+        self.apply_transfer_function(layer)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      self.ui.log.insertPlainText('Error reading {}: {}\n'.format(args.transfer_function, e))
+      return
+    self.ui.log.insertPlainText('Reloaded {}\n'.format(args.transfer_function))
+    self.ui.vtkWidget.GetRenderWindow().Render()
+
+  def set_surface(self, layer, surface):
+    actor = self.layers[layer][0]
+    self.shown_surfaces[layer] = surface
+    actor.GetMapper().SetInputData(surface.mesh(self.interacting))
+
+  def interaction_callback(self, obj, event):
+    # the interactor style renders once more (at full detail) after the end event
+    self.interacting = event == "StartInteractionEvent"
+    with timer.stage("actor swap"):
+      for layer, surface in self.shown_surfaces.items():
+        self.layers[layer][0].GetMapper().SetInputData(surface.mesh(self.interacting))
+      for layer in args.volume:
+        set_volume_detail(self.layers[layer][0], args.volume_lod if self.interacting else 1)
+
+  def cache_callbacks(self, layer, interpolated):
+    # on_ready/on_failed of a layer's cache, handing its results to the GUI thread
+    return dict(on_ready=lambda index, surface: self.surface_ready.emit(layer, interpolated, index, surface),
+                on_failed=lambda index, error: self.surface_failed.emit(layer, interpolated, index, str(error)))
+
+  def frame_source(self, layer, frame):
+    # cache and index holding a layer's surface for an animation frame
+    _, _, cache, tween_cache = self.layers[layer]
+    hour, tween = self.frames[frame]
+    if tween is None:
+      return cache, hour
+    return tween_cache, tween
+
+  def show_layer(self, layer):
+    # swap in the surface for the current frame if it is cached, otherwise keep showing
+    # the previous surface while it is computed in the background (surface_ready_callback)
+    actor, _, hour_cache, _ = self.layers[layer]
+    cache, index = self.frame_source(layer, self.current_frame)
+    surface = cache.peek(index)
+    with timer.stage("actor swap"):
+      if surface is not None:
+        self.set_surface(layer, surface)
+      else:
+        cache.request(index)
+      if actor.GetMapper().GetInput() is not None:
+        self.ren.AddActor(actor)
+    cache.prefetch(index)
+    if cache is not hour_cache:
+      hour_cache.prefetch(self.current_time)
+
+  def surface_ready_callback(self, layer, interpolated, index, surface):
+    actor, check, _, tween_cache = self.layers[layer]
+    cache, current_index = self.frame_source(layer, self.current_frame)
+    # the user may have moved on to another timestep or hidden the layer meanwhile
+    if (cache is tween_cache) != interpolated or index != current_index or not check.isChecked():
+      return
+    with timer.stage("actor swap"):
+      self.set_surface(layer, surface)
+      self.ren.AddActor(actor)
+    self.ui.vtkWidget.GetRenderWindow().Render()
+
+  def surface_failed_callback(self, layer, interpolated, index, error):
+    kind = "interpolated frame" if interpolated else "timestep"
+    self.ui.log.insertPlainText('Error computing {} {} of {}: {}\n'.format(kind, index, layer, error))
+
+  def render_start_callback(self, obj, event):
+    self.render_start = time.perf_counter()
+    if self.ui.stats_check.isChecked():
+      self.stats_actor.SetInput(stats_text(timer.summary(), self.frame_rate()))
+
+  def render_end_callback(self, obj, event):
+    end = time.perf_counter()
+    self.render_ends.append(end)
+    if self.render_start is not None:
+      timer.record("render", self.render_start, end - self.render_start)
+
+  def frame_rate(self):
+    # frames per second over the renders that ended in the last FPS_WINDOW seconds,
+    # None until there are two of them
+    now = time.perf_counter()
+    ends = [end for end in self.render_ends if now - end <= FPS_WINDOW]
+    if len(ends) < 2:
+      return None
+    return (len(ends) - 1) / (ends[-1] - ends[0])
+
+  def play_callback(self):
+    if self.play_timer.isActive():
+      self.play_timer.stop()
+      self.ui.push_play.setText('Play')
+      self.ui.log.insertPlainText('Paused at time {}\n'.format(self.current_time))
+    else:
+      self.play_timer.start()
+      self.ui.push_play.setText('Pause')
+      self.ui.log.insertPlainText('Playing at {} fps\n'.format(args.fps))
+
+  def play_step(self):
+    next_frame = (self.current_frame + 1) % len(self.frames)
+
+    # until a frame's surfaces have all been computed (first loop) playback waits on it,
+    # once they are cached it runs at the timer's rate
+    ready = True
+    for layer, (_, check, _, _) in self.layers.items():
+      if check.isChecked():
+        cache, index = self.frame_source(layer, next_frame)
+        # a surface that failed would never arrive, so stop instead of waiting forever
+        error = cache.error(index)
+        if error is not None:
+          self.play_timer.stop()
+          self.ui.push_play.setText('Play')
+          self.ui.log.insertPlainText('Stopped at time {}, {} failed for the next frame: {}\n'.format(self.current_time, layer, error))
+          return
+        if cache.peek(index) is None:
+          cache.request(index)
+          ready = False
+    if not ready:
+      return
+
+    self.current_frame = next_frame
+    self.current_time = self.frames[next_frame][0]
+    self.ui.folder1_time_slider.blockSignals(True)
+    self.ui.folder1_time_slider.setValue(self.current_time)
+    self.ui.folder1_time_slider.blockSignals(False)
+
+    for layer, (_, check, _, _) in self.layers.items():
+      if check.isChecked():
+        self.show_layer(layer)
+    self.ui.vtkWidget.GetRenderWindow().Render()
+
+  def isovalue_callback(self, val):
+    sender = self.sender()
+
+    # the old surfaces stay on screen until the new ones are ready, the current
+    # timestep is re-contoured first and jobs for the previous isovalue are dropped,
+    # volume rendered layers only need a new transfer function
+    if sender is self.ui.folder1_iso_slider:
+      self.isovalue1 = slider_to_isovalue(self.folder1_range, val)
+      self.ui.iso1_label.setText(f"Folder 1 isovalue: {self.isovalue1:.4g}")
+      if "folder1" in args.volume:
+        self.apply_transfer_function("folder1")
+        self.ui.vtkWidget.GetRenderWindow().Render()
+      else:
+        self.folder1_cache.invalidate()
+        self.folder1_tween_cache.invalidate()
+      self.ui.log.insertPlainText('Folder 1 isovalue {:.4g}\n'.format(self.isovalue1))
+    elif sender is self.ui.folder2_iso_slider:
+      self.isovalue2 = slider_to_isovalue(self.folder2_range, val)
+      self.ui.iso2_label.setText(f"Folder 2 isovalue: {self.isovalue2:.4g}")
+      if "folder2" in args.volume:
+        self.apply_transfer_function("folder2")
+        self.ui.vtkWidget.GetRenderWindow().Render()
+      else:
+        self.folder2_cache.invalidate()
+        self.folder2_tween_cache.invalidate()
+      self.ui.log.insertPlainText('Folder 2 isovalue {:.4g}\n'.format(self.isovalue2))
+
   def slider_callback(self, val):
     self.current_time = val
-    # remove previous actor
+    self.current_frame = self.frames.index((val, None))
+    # show active actors
     if self.ui.p1_check.isChecked():
-      for actor in self.folder1_actors:
-        self.ren.RemoveActor(actor)
-      # add active actor
-      self.ren.AddActor(self.folder1_actors[val])
+      self.show_layer("folder1")
 
-    # remove previous actor
     if self.ui.p2_check.isChecked():
-      for actor in self.folder2_actors:
-        self.ren.RemoveActor(actor)
-      # add active actor
-      self.ren.AddActor(self.folder2_actors[val])
+      self.show_layer("folder2")
 
-    # remove previous actor
     if self.ui.p3_check.isChecked():
-      for actor in self.folder3_actors:
-        self.ren.RemoveActor(actor)
-      # add active actor
-      self.ren.AddActor(self.folder3_actors[val])
+      self.show_layer("folder3")
+
+    if args.field and self.ui.p4_check.isChecked():
+      self.show_layer("folder4")
 
     self.ui.log.insertPlainText('Displaying time {}\n'.format(val))
     self.ui.vtkWidget.GetRenderWindow().Render()
@@ -362,41 +1163,211 @@ class IsoVis(QMainWindow):
 
     if sender is self.ui.p1_check:
       if self.ui.p1_check.isChecked():
-        self.ren.AddActor(self.folder1_actors[self.current_time])
+        self.show_layer("folder1")
       else:
-        self.ren.RemoveActor(self.folder1_actors[self.current_time])
+        with timer.stage("actor swap"):
+          self.ren.RemoveActor(self.folder1_actor)
     elif sender is self.ui.p2_check:
       if self.ui.p2_check.isChecked():
-        self.ren.AddActor(self.folder2_actors[self.current_time])
+        self.show_layer("folder2")
       else:
-        self.ren.RemoveActor(self.folder2_actors[self.current_time])
+        with timer.stage("actor swap"):
+          self.ren.RemoveActor(self.folder2_actor)
     elif sender is self.ui.p3_check:
       if self.ui.p3_check.isChecked():
-        self.ren.AddActor(self.folder3_actors[self.current_time])
+        self.show_layer("folder3")
+      else:
+        with timer.stage("actor swap"):
+          self.ren.RemoveActor(self.folder3_actor)
+    elif sender is self.ui.p4_check:
+      if self.ui.p4_check.isChecked():
+        self.show_layer("folder4")
       else:
-        self.ren.RemoveActor(self.folder3_actors[self.current_time])
+        with timer.stage("actor swap"):
+          self.ren.RemoveActor(self.field_actor)
     elif sender is self.ui.map_check:
       if self.ui.map_check.isChecked():
         self.ren.AddActor(self.map_actor)
       else:
         self.ren.RemoveActor(self.map_actor)
+    elif sender is self.ui.stats_check:
+      if self.ui.stats_check.isChecked():
+        self.ren.AddViewProp(self.stats_actor)
+      else:
+        self.ren.RemoveViewProp(self.stats_actor)
 
     self.ui.vtkWidget.GetRenderWindow().Render()
 
+# ==== headless rendering (--headless) ====
+# every worker process builds the scene once in an offscreen render window,
+# then renders the frames it is handed
+headless_scene = None
+
+def init_headless_worker(worker_args, num_workers):
+  global args, headless_scene
+  args = worker_args
+
+  # split the cores between the worker processes
+  vtk.vtkSMPTools.SetBackend('STDThread')
+  vtk.vtkSMPTools.Initialize(args.threads or max(1, (os.cpu_count() or 1) // num_workers))
+
+  map_actor, folder1_actor, folder2_actor, folder3_actor = make_scene_actors(args.volume, args.threads)
+  ren = vtk.vtkRenderer()
+  ren.SetBackground(BACKGROUND_COLOR)
+  ren.AddActor(map_actor)
+  if args.camera:
+    ren.SetActiveCamera(load_camera(args.camera))
+  else:
+    ren.SetActiveCamera(set_camera(default_cam))
+
+  window = vtk.vtkRenderWindow()
+  window.SetOffScreenRendering(1)
+  window.SetSize(args.size)
+  window.AddRenderer(ren)
+
+  contour_options = contour_options_from_args(args)
+  surface_cache = surface_cache_from_args(args)
+  folder1_loaders = timestep_loaders(args.folder1[0], args.crop)
+  folder2_loaders = timestep_loaders(args.folder2[0], args.crop)
+  folder3_loaders = timestep_loaders(args.pressure, args.crop and args.crop[:4])
+  isovalue1 = float(args.folder1[1])
+  isovalue2 = float(args.folder2[1])
+  pressure_mesh = PressureMesh(folder3_loaders[0](), PRESSURE_SCALE_FACTOR)
+
+  # volume rendered layers are handed each timestep's volume as it is
+  transfer_functions = load_transfer_functions(args.transfer_function)
+  surfaces = {}
+  for layer, loaders, isovalue, actor in (("folder1", folder1_loaders, isovalue1, folder1_actor),
+                                          ("folder2", folder2_loaders, isovalue2, folder2_actor)):
+    if layer in args.volume:
+      set_transfer_function(actor, isovalue, isovalue_range(loaders[0](), isovalue), transfer_functions.get(layer))
+      surfaces[layer] = lambda timestep: timestep()
+    else:
+      surfaces[layer] = lambda timestep, isovalue=isovalue: contour_timestep(timestep, isovalue, contour_options, surface_cache, args.bricks)
+
+  headless_scene = {
+    "window": window,
+    "renderer": ren,
+    # (loaders, surface of a timestep, actor) per layer
+    "layers": [
+      (folder1_loaders, surfaces["folder1"], folder1_actor),
+      (folder2_loaders, surfaces["folder2"], folder2_actor),
+      (folder3_loaders, lambda timestep: pressure_mesh.show(pressure_heights(timestep)), folder3_actor),
+    ],
+  }
+
+  if args.field:
+    field_loaders = timestep_loaders(args.field, args.crop and args.crop[:4])
+    first_field = field_loaders[0]()
+    field_mesh = PressureMesh(first_field, args.field_scale, colored=True)
+    headless_scene["layers"].append((field_loaders, lambda timestep: field_mesh.show(pressure_heights(timestep)),
+                                     make_field_actor(field_range(first_field))))
+
+def render_frame(index):
+  window = headless_scene["window"]
+  ren = headless_scene["renderer"]
+  for loaders, make_surface, actor in headless_scene["layers"]:
+    # folders with fewer timesteps are left out of the later frames
+    if index < len(loaders):
+      actor.GetMapper().SetInputData(make_surface(loaders[index]))
+      ren.AddActor(actor)
+    else:
+      ren.RemoveActor(actor)
+
+  with timer.stage("render"):
+    window.Render()
+    image = vtk.vtkWindowToImageFilter()
+    image.SetInput(window)
+    image.SetScale(args.screenshot_scale)
+    image.ReadFrontBufferOff()
+    image.Update()
+  with timer.stage("png write"):
+    png_writer = vtk.vtkPNGWriter()
+    png_writer.SetInputData(image.GetOutput())
+    file_name = os.path.join(args.headless, "frame" + str(index).zfill(5) + ".png")
+    png_writer.SetFileName(file_name)
+    png_writer.Write()
+  # the timings go back to the main process for --trace
+  return file_name, os.getpid(), timer.take()
+
+def render_headless(args):
+  os.makedirs(args.headless, exist_ok=True)
+  num_frames = len(timestep_loaders(args.folder1[0]))
+  num_workers = max(1, min(args.workers, num_frames))
+  print(f"Rendering {num_frames} frames to {args.headless} with {num_workers} processes")
+
+  with ProcessPoolExecutor(max_workers=num_workers, initializer=init_headless_worker, initargs=(args, num_workers)) as pool:
+    for file_name, pid, records in pool.map(render_frame, range(num_frames)):
+      timer.merge(records, f"worker {pid} ")
+      print(file_name + " has been successfully exported")
+
 class CustomArgumentParser(argparse.ArgumentParser):
   def error(self, message):
     print(f"Error: {message}\n")
     print("Usage: python atmosphere_vis --folder1 <name of folder1> <isovalue> --folder2 <name of folder2> <isovalue> --pressure <name of pressure layer folder>\n")
     sys.exit(2)
 
-if __name__ == '__main__':
+def make_parser():
+  # command line options, also used by benchmark_suite.py to set up the scene
   parser = CustomArgumentParser()
-  parser.add_argument('--folder1', type=str, nargs=2, required=True, help='variable arrays folder')
-  parser.add_argument('--folder2', type=str, nargs=2, required=True, help='variable arrays folder 2')
-  parser.add_argument('--pressure', type=str, required=True, help='name of pressure layer folder')
+  parser.add_argument('--folder1', type=str, nargs=2, required=True, help='variable arrays folder (or .vstore file)')
+  parser.add_argument('--folder2', type=str, nargs=2, required=True, help='variable arrays folder 2 (or .vstore file)')
+  parser.add_argument('--pressure', type=str, required=True, help='name of pressure layer folder (or .vstore file)')
+  parser.add_argument('--field', type=str, help='folder (or .vstore file) of a 2D derived field (see derived_fields.py) shown as a colored surface')
+  parser.add_argument('--field-scale', type=float, default=1.0, help='height of the --field surface per unit of value, 1 puts top_index/base_index at their level in the volumes, 0 keeps it flat')
+  parser.add_argument('--field-range', type=float, nargs=2, metavar=('MIN', 'MAX'), help='values colored blue to red on the --field surface, lower values are hidden (default: non-negative range of the first timestep)')
   parser.add_argument('--camera', type=str, help='camera position')
+  parser.add_argument('--cache-mb', type=int, default=2048, help='memory budget (MB) for cached surfaces')
+  parser.add_argument('--prefetch', type=int, default=2, help='number of timesteps on each side to prefetch')
+  parser.add_argument('--contour', type=str, default='flying-edges', choices=list(CONTOUR_BACKENDS), help='isosurface extraction filter')
+  parser.add_argument('--no-normals', action='store_true', help='skip computing isosurface normals (flat shading)')
+  parser.add_argument('--no-merge', action='store_true', help='skip merging duplicate isosurface points (--contour marching-cubes only, the other filters always merge)')
+  parser.add_argument('--surface-cache', type=str, default='surface_cache', help='folder for cached isosurfaces')
+  parser.add_argument('--surface-cache-mb', type=int, default=4096, help='size limit (MB) of the isosurface cache, 0 disables it')
+  parser.add_argument('--fps', type=float, default=10, help='target frame rate of the animation playback')
+  parser.add_argument('--substeps', type=int, default=3, help='frames interpolated between each pair of hours during playback')
+  parser.add_argument('--tween-cache-mb', type=int, default=1024, help='memory budget (MB) for cached interpolated surfaces, on top of --cache-mb')
+  parser.add_argument('--lod-reduction', type=float, default=0.9, help='fraction of isosurface triangles removed for the mesh shown while the camera moves, 0 disables')
+  parser.add_argument('--lod-filter', type=str, default='clustering', choices=['clustering', 'decimation'], help='vtkQuadricClustering (fast) or vtkQuadricDecimation (closer to the requested reduction)')
+  parser.add_argument('--volume', type=str, nargs='+', default=[], choices=['folder1', 'folder2'], help='show these folders by CPU volume rendering instead of isosurfaces')
+  parser.add_argument('--transfer-function', type=str, help='JSON color/opacity transfer functions of the volume rendered folders, reloaded when the file changes')
+  parser.add_argument('--volume-lod', type=int, default=2, help='image and ray sample distance factor of the volume rendering while the camera moves, 1 disables')
+  parser.add_argument('--crop', type=float, nargs='+', metavar='BOUND', help='X0 X1 Y0 Y1 [Z0 Z1]: only show the part of the volumes inside this box (grid points), cut out before contouring')
+  parser.add_argument('--bricks', type=int, default=32, help='brick size (cells) of the min/max index used to skip empty regions, 0 contours whole volumes')
+  parser.add_argument('--threads', type=int, default=0, help='threads used by the multithreaded filters (0 = all cores)')
+  parser.add_argument('--screenshot-scale', type=int, default=1, help='magnification of saved images, rendered in scale x scale tiles')
+  parser.add_argument('--trace', type=str, help='save the stage timings on exit (.json trace event file or .csv)')
+  parser.add_argument('--profile', type=str, help='save a cProfile of the session on exit (view with python -m pstats)')
+  parser.add_argument('--headless', type=str, metavar='OUTDIR', help='render every timestep to numbered PNGs in OUTDIR without opening a window')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes rendering frames in --headless mode')
+  parser.add_argument('--size', type=int, nargs=2, default=[1920, 1080], metavar=('WIDTH', 'HEIGHT'), help='image size in --headless mode')
+  return parser
 
+if __name__ == '__main__':
+  parser = make_parser()
   args = parser.parse_args()
+  if args.crop and len(args.crop) not in (4, 6):
+    parser.error("--crop takes 4 (x and y) or 6 (x, y and z) values")
+  if args.no_merge and args.contour != 'marching-cubes':
+    parser.error(f"--no-merge only applies to --contour marching-cubes, {args.contour} always merges points")
+
+  # timings and the profile are saved when the program exits, however it exits
+  if args.trace:
+    atexit.register(timer.export, args.trace)
+  if args.profile:
+    profiler = cProfile.Profile()
+    atexit.register(profiler.dump_stats, args.profile)
+    atexit.register(print, f"saved profile in {args.profile}")
+    atexit.register(profiler.disable)
+    profiler.enable()
+
+  if args.headless:
+    render_headless(args)
+    sys.exit()
+
+  # let the multithreaded VTK filters (flying edges) use several cores
+  vtk.vtkSMPTools.SetBackend('STDThread')
+  vtk.vtkSMPTools.Initialize(args.threads)
 
   # initialize app and window
   app = QApplication(sys.argv)
@@ -413,9 +1384,17 @@ if __name__ == '__main__':
   window.ui.push_camera.clicked.connect(window.save_camera_callback)
   # time slider connection
   window.ui.folder1_time_slider.valueChanged.connect(window.slider_callback)
+  window.ui.push_play.clicked.connect(window.play_callback)
+  # isovalue slider connections
+  window.ui.folder1_iso_slider.valueChanged.connect(window.isovalue_callback)
+  window.ui.folder2_iso_slider.valueChanged.connect(window.isovalue_callback)
   # checkbox connection
   window.ui.p1_check.stateChanged.connect(window.checkbox_callback)
   window.ui.p2_check.stateChanged.connect(window.checkbox_callback)
   window.ui.p3_check.stateChanged.connect(window.checkbox_callback)
+  window.ui.p4_check.stateChanged.connect(window.checkbox_callback)
   window.ui.map_check.stateChanged.connect(window.checkbox_callback)
-  sys.exit(app.exec())
\ No newline at end of file
+  window.ui.stats_check.stateChanged.connect(window.checkbox_callback)
+  status = app.exec()
+  window.frame_writer.close()
+  sys.exit(status)
\ No newline at end of file
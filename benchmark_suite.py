@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+from atmosphere_vis import (CONTOUR_BACKENDS, BLANK_IMAGE, PRESSURE_SCALE_FACTOR, PressureMesh, make_parser,
+                            make_pressure_layer_actor, make_variable_contour_filters, pressure_heights,
+                            timestep_loaders, init_headless_worker, render_frame)
+from level_stack import decode_workers, stack_levels
+from vti_io import DEFAULT_ENCODING, make_image_data, read_vti, write_vti
+
+'''
+Times the main code paths on synthetic data the size of the HRRR grid
+(1798 x 1058 points, 25 pressure levels, float32), so runs can be compared
+over time without downloading anything. The data comes from a fixed seed:
+sparse cloud like volumes (cloud mixing ratio), smooth stratified volumes
+(temperature) and smooth height layers (1000 hPa geopotential height).
+
+Stages:
+  assemble        - level_stack.stack_levels, as combo_grab_volume.convert runs it
+                    (--decode-workers processes stacking the levels into shared
+                    memory), with the levels read from a .npy file instead of
+                    decoded from GRIB2
+  vti write       - write_vti with the default encoding (as the extract scripts)
+  vti read        - read_vti (vtkXMLImageDataReader)
+  contour <name>  - make_variable_contour_filters with each --contour backend
+  pressure layer  - make_pressure_layer_actor and the shared pressure mesh, all hours
+  scene setup     - building the atmosphere_vis.py scene (as --headless does)
+  render frames   - loading, contouring and rendering every hour of the full scene
+                    offscreen, and writing them as PNGs ("render" is one draw alone)
+
+Every stage runs --repeat times, the results (best, mean and every run, in
+seconds) are saved as JSON with the machine and library versions. --compare
+prints the speedup of each stage against an earlier results file.
+
+Usage: python benchmark_suite.py [--output <.json>] [--compare <.json>] [--repeat <n>]
+                                 [--hours <n>] [--size <nx> <ny> <nz>] [--seed <n>]
+                                 [--threads <n>] [--decode-workers <n>] [--no-render]
+'''
+
+CLOUD_ISOVALUE = 0.0001
+TEMPERATURE_ISOVALUE = 260.0
+
+def smooth_noise(shape, cells, rng):
+  # random values between 0 and 1 on a coarse grid (one point every `cells` points),
+  # linearly interpolated up to shape (nz, ny, nx)
+  nz, ny, nx = shape
+  coarse = [-(-size // cells) + 1 if size > 1 else 1 for size in shape]
+  image_data = make_image_data(rng.random(coarse, dtype=np.float32), "noise")
+
+  interpolator = vtk.vtkImageInterpolator()
+  interpolator.SetInterpolationModeToLinear()
+  resize = vtk.vtkImageResize()
+  resize.SetInputData(image_data)
+  resize.SetInterpolator(interpolator)
+  resize.SetResizeMethodToOutputDimensions()
+  resize.SetOutputDimensions(nx, ny, nz)
+  resize.Update()
+  return vtk_to_numpy(resize.GetOutput().GetPointData().GetScalars()).reshape(shape)
+
+def synthetic_hour(size, seed, hour):
+  # (cloud mixing ratio, temperature, 1000 hPa height) of one hour
+  nx, ny, nz = size
+  rng = np.random.default_rng([seed, hour])
+
+  # mostly zero, with cloud cells a few tens of points across
+  clouds = smooth_noise((nz, ny, nx), 24, rng)
+  np.subtract(clouds, 0.75, out=clouds)
+  np.maximum(clouds, 0.0, out=clouds)
+  np.multiply(clouds, np.float32(0.004), out=clouds)
+
+  # colder with height, with large scale waves
+  temperature = smooth_noise((nz, ny, nx), 150, rng)
+  np.multiply(temperature, np.float32(12.0), out=temperature)
+  temperature += (290.0 - 2.5 * np.arange(nz, dtype=np.float32))[:, np.newaxis, np.newaxis]
+
+  height = smooth_noise((1, ny, nx), 200, rng)[0]
+  np.multiply(height, np.float32(150.0), out=height)
+  height += np.float32(25.0)
+  return clouds, temperature, height
+
+def read_saved_level(file_name, i):
+  # stands in for combo_grab_volume.decode_level
+  return np.load(file_name, mmap_mode="r")[i]
+
+def assemble_volume(file_name, workers):
+  # the levels saved in GRIB message order (lowest pressure first), stacked by the
+  # code combo_grab_volume.convert runs
+  levels = np.load(file_name, mmap_mode="r")
+  jobs = [(i, (file_name, i)) for i in range(levels.shape[0])]
+  return stack_levels(levels.shape, read_saved_level, jobs, lambda volume_3d: float(volume_3d[0, 0, 0]), workers)
+
+def measure(results, name, function, repeat, **info):
+  # runs function repeat times, records the times (and any extra info) under name
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    value = function()
+    times.append(time.perf_counter() - start)
+  results[name] = {"best_s": min(times), "mean_s": sum(times) / len(times), "runs_s": times, **info}
+  print(f"{name:<32}{min(times):>10.3f}{sum(times) / len(times):>10.3f}")
+  return value
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run_suite(work_dir, size, hours, repeat, seed, threads, decode_workers, render):
+  results = {}
+  folders = {name: os.path.join(work_dir, name) for name in ("clouds", "temperature", "pressure")}
+  for folder in folders.values():
+    os.makedirs(folder)
+
+  print(f"{'stage':<32}{'best s':>10}{'mean s':>10}")
+
+  # the synthetic hours are written the way the extract scripts write them,
+  # the first hour's write and read are timed
+  for hour in range(hours):
+    clouds, temperature, height = synthetic_hour(size, seed, hour)
+    outputs = [(clouds, "Cloud mixing ratio", "clouds"), (temperature, "Temperature", "temperature"),
+               (height[np.newaxis], "Geopotential height_1000hPa", "pressure")]
+    for values, name, folder in outputs:
+      file_name = os.path.join(folders[folder], f"{name}_{hour:02d}.vti")
+      if hour == 0 and folder == "clouds":
+        levels_file = os.path.join(work_dir, "levels.npy")
+        np.save(levels_file, values[::-1])
+        measure(results, "assemble", lambda: assemble_volume(levels_file, decode_workers), repeat, workers=decode_workers)
+        os.remove(levels_file)
+        measure(results, "vti write", lambda: write_vti(values, name, file_name, DEFAULT_ENCODING), repeat)
+        results["vti write"]["bytes"] = os.path.getsize(file_name)
+      else:
+        write_vti(values, name, file_name, DEFAULT_ENCODING)
+
+  cloud_file = os.path.join(folders["clouds"], "Cloud mixing ratio_00.vti")
+  image_data = measure(results, "vti read", lambda: read_vti(cloud_file), repeat)
+
+  for backend in CONTOUR_BACKENDS:
+    output = measure(results, f"contour {backend}",
+                     lambda: make_variable_contour_filters(image_data, CLOUD_ISOVALUE, backend).GetOutput(), repeat)
+    results[f"contour {backend}"]["triangles"] = output.GetNumberOfPolys()
+
+  pressure_loaders = timestep_loaders(folders["pressure"])
+  def pressure_layer():
+    image_reader = vtk.vtkPNGReader()
+    image_reader.SetFileName(BLANK_IMAGE)
+    image_reader.Update()
+    actor = make_pressure_layer_actor(image_reader.GetOutput())
+    pressure_mesh = PressureMesh(pressure_loaders[0](), PRESSURE_SCALE_FACTOR)
+    for timestep in pressure_loaders:
+      actor.GetMapper().SetInputData(pressure_mesh.show(pressure_heights(timestep)))
+    return actor
+  measure(results, "pressure layer", pressure_layer, repeat, hours=hours)
+
+  if render:
+    # the same scene and code path as atmosphere_vis.py --headless, in this process
+    frames_dir = os.path.join(work_dir, "frames")
+    os.makedirs(frames_dir)
+    args = make_parser().parse_args(["--folder1", folders["clouds"], str(CLOUD_ISOVALUE),
+                                     "--folder2", folders["temperature"], str(TEMPERATURE_ISOVALUE),
+                                     "--pressure", folders["pressure"], "--headless", frames_dir,
+                                     "--surface-cache-mb", "0", "--threads", str(threads), "--size", "1920", "1080"])
+    measure(results, "scene setup", lambda: init_headless_worker(args, 1), 1)
+
+    # render_frame hands back the stage timings of each frame
+    records = []
+    def render_frames():
+      for hour in range(hours):
+        records.extend(render_frame(hour)[2])
+    measure(results, "render frames", render_frames, repeat, hours=hours)
+    draws = [duration for name, _, duration, _ in records if name == "render"]
+    results["render"] = {"best_s": min(draws), "mean_s": sum(draws) / len(draws), "runs_s": draws}
+    print(f"{'render':<32}{min(draws):>10.3f}{sum(draws) / len(draws):>10.3f}")
+
+  return results
+
+def compare(report, file_name):
+  with open(file_name) as old_file:
+    old_report = json.load(old_file)
+  if old_report["settings"] != report["settings"] or old_report["machine"] != report["machine"]:
+    print(f"\nNOTE: {file_name} was run with other settings or on another machine")
+
+  old = old_report["results"]
+  results = report["results"]
+  print(f"\n{'stage':<32}{'before s':>10}{'now s':>10}{'speedup':>10}")
+  for name, result in results.items():
+    if name in old:
+      before = old[name]["best_s"]
+      print(f"{name:<32}{before:>10.3f}{result['best_s']:>10.3f}{before / result['best_s']:>9.2f}x")
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--output', type=str, default='benchmark_results.json', help='JSON file the results are saved to')
+  parser.add_argument('--compare', type=str, help='earlier results file to compare against')
+  parser.add_argument('--repeat', type=int, default=3, help='number of runs of each stage')
+  parser.add_argument('--hours', type=int, default=2, help='number of synthetic hours to generate')
+  parser.add_argument('--size', type=int, nargs=3, default=[1798, 1058, 25], metavar=('NX', 'NY', 'NZ'), help='grid size of the synthetic volumes')
+  parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+  parser.add_argument('--threads', type=int, default=0, help='threads for the multithreaded filters (0 = all cores)')
+  parser.add_argument('--decode-workers', type=int, default=decode_workers(2), help='processes stacking the levels in the assemble stage (default: as combo_grab_volume.py with PIPELINE and 2 CONVERT_WORKERS)')
+  parser.add_argument('--no-render', action='store_true', help='skip the offscreen render of the full scene')
+  args = parser.parse_args()
+
+  vtk.vtkSMPTools.SetBackend('STDThread')
+  vtk.vtkSMPTools.Initialize(args.threads)
+
+  with tempfile.TemporaryDirectory() as work_dir:
+    results = run_suite(work_dir, args.size, args.hours, args.repeat, args.seed, args.threads, args.decode_workers, not args.no_render)
+
+  report = {
+    "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "commit": git_commit(),
+    "machine": {"host": platform.node(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                "threads": vtk.vtkSMPTools.GetEstimatedNumberOfThreads()},
+    "versions": {"python": platform.python_version(), "numpy": np.__version__, "vtk": vtk.vtkVersion.GetVTKVersion()},
+    "settings": {"size": args.size, "hours": args.hours, "repeat": args.repeat, "seed": args.seed,
+                 "encoding": DEFAULT_ENCODING},
+    "results": results,
+  }
+  with open(args.output, "w") as output:
+    json.dump(report, output, indent=2)
+  print(f"\nsaved results in {args.output}")
+
+  if args.compare:
+    compare(report, args.compare)
@@ -0,0 +1,72 @@
+import numpy as np
+from vtk.util.numpy_support import vtk_to_numpy
+
+'''
+Min/max (span space) index over the bricks of a volume, used to contour only the
+parts of the volume that can contain the isosurface. Most of a cloud mixing
+ratio volume is zero, so most bricks are skipped.
+
+The volume is split into bricks of brick_size x brick_size x brick_size cells.
+Neighbouring bricks share their boundary points, so each brick's min/max covers
+every point its cells touch. The bricks are sorted by their min value, so the
+bricks for a new isovalue are found with a binary search instead of a scan.
+Active bricks next to each other along x are contoured as one extent to keep
+the number of filter runs (and seams) down.
+'''
+
+def _reduce_axis(values, axis, brick_size, ufunc):
+  # reduce each brick's slab of points along one axis, a brick's points run up to
+  # and including the first plane of the next brick
+  n = values.shape[axis]
+  slabs = []
+  for start in range(0, max(n - 1, 1), brick_size):
+    index = [slice(None)] * values.ndim
+    index[axis] = slice(start, min(start + brick_size, n - 1) + 1)
+    slabs.append(ufunc.reduce(values[tuple(index)], axis=axis))
+  return np.stack(slabs, axis=axis)
+
+class BrickIndex:
+  def __init__(self, image_data, brick_size=32):
+    nx, ny, nz = image_data.GetDimensions()
+    values = vtk_to_numpy(image_data.GetPointData().GetScalars()).reshape(nz, ny, nx)
+
+    self.brick_size = brick_size
+    self.dimensions = (nx, ny, nz)
+
+    mins, maxs = values, values
+    for axis in range(3):
+      mins = _reduce_axis(mins, axis, brick_size, np.minimum)
+      maxs = _reduce_axis(maxs, axis, brick_size, np.maximum)
+    self.shape = mins.shape  # (bricks in z, y, x)
+
+    self.order = np.argsort(mins, axis=None, kind="stable")
+    self.sorted_mins = mins.ravel()[self.order]
+    self.maxs = maxs.ravel()
+
+  def __len__(self):
+    return self.maxs.size
+
+  def active_bricks(self, isovalue):
+    # flat indices of the bricks whose [min, max] contains the isovalue
+    count = np.searchsorted(self.sorted_mins, isovalue, side="right")
+    candidates = self.order[:count]
+    return np.sort(candidates[self.maxs[candidates] >= isovalue])
+
+  def extents(self, isovalue):
+    # point extents (x0, x1, y0, y1, z0, z1) to contour, one per run of active bricks along x
+    nx, ny, nz = self.dimensions
+    size = self.brick_size
+    extents = []
+    run_start = previous = None
+    for brick in self.active_bricks(isovalue).tolist() + [None]:
+      if brick is not None and previous is not None and brick == previous + 1 and brick % self.shape[2] != 0:
+        previous = brick
+        continue
+      if run_start is not None:
+        bz, by, bx = np.unravel_index(run_start, self.shape)
+        last_x = previous % self.shape[2]
+        extents.append((bx * size, min((last_x + 1) * size, nx - 1),
+                        by * size, min((by + 1) * size, ny - 1),
+                        bz * size, min((bz + 1) * size, nz - 1)))
+      run_start = previous = brick
+    return extents
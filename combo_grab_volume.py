@@ -1,11 +1,17 @@
-from herbie import Herbie
 import pandas as pd
 import numpy as np
 import pygrib  # For reading GRIB2 files
-import vtk
-from vtk.util.numpy_support import numpy_to_vtk
-import requests
 import os
+from grib_fetch import download_subset
+from grib_cache import GribCache
+from ingest_pipeline import run_pipeline, watch
+from data_source import open_source
+from ingest_manifest import IngestManifest
+from volume_store import open_store, write_timestep, STORE_EXTENSION
+from vti_io import write_vti
+from grid_region import region_slices, region_origin
+from derived_fields import derive_fields
+from level_stack import decode_workers, stack_levels
 
 """
   Interesting variables in GRIB2 file:
@@ -24,37 +30,100 @@ GRIB_FILE_PATH = "temp_hrrr.grib2"
 DATE = "2025-04-07"
 START_TIME = 0
 END_TIME = 5
+MIN_LEVEL = 400
+MAX_LEVEL = 1000
+PIPELINE = True
+DOWNLOAD_WORKERS = 4
+CONVERT_WORKERS = 2
+# with PIPELINE every convert process has its own decode pool, so the cores are split between them
+DECODE_WORKERS = decode_workers(CONVERT_WORKERS if PIPELINE else 1)
+CACHE_DIR = "grib_cache"
+CACHE_MAX_BYTES = 20 * 1024**3
+VOLUME_STORE = True
+# see vti_io.py for the options, storage "float16"/"uint16" trade precision for space
+VTI_ENCODING = {"data_mode": "raw", "compressor": "zlib", "level": 5, "block_size": 32768, "storage": "float32"}
+# only write part of the grid, e.g. {"x": (600, 1200), "y": (300, 800)} (grid indices)
+# or {"lat": (30, 45), "lon": (-105, -90)}, see grid_region.py; None writes everything
+REGION = None
+# finished outputs are recorded here with their size and checksum, reruns skip
+# them and only redo the hours that failed; None disables it
+MANIFEST_FILE = "ingest_manifest.json"
+# also compare checksums (not only sizes) of recorded outputs before skipping them
+MANIFEST_VERIFY = False
+# keep polling for hours that are not published yet and ingest each as it appears
+WATCH = False
+POLL_SECONDS = 300
+# a watched hour that fails this many times is given up on (and reported)
+WATCH_ATTEMPTS = 3
+# read the GRIB2 files from a local copy of the archive (e.g. an NFS mirror) instead of
+# downloading them, see data_source.py for the layout; None downloads
+SOURCE_DIR = None
+# 2D fields computed from each volume before it is freed, e.g. ["top_index", "column_total"]
+# (see derived_fields.py), written as "<VARIABLE>_<field>_<date>_<hour>.vti" layers; [] writes none
+DERIVED_FIELDS = []
+# values above this count for top_index/base_index/top_pressure (e.g. 1e-5 kg/kg of cloud)
+DERIVED_THRESHOLD = 1e-5
+
+def available(date, time):
+  # whether the hour has been published (or is in SOURCE_DIR)
+  return open_source(SOURCE_DIR).available(pd.Timestamp(f"{date} {time}:00"))
+
+def download(date, time, file_name):
+  run_time = pd.Timestamp(f"{date} {time}:00")
+
+  # Download only the VARIABLE messages between MIN_LEVEL and MAX_LEVEL,
+  # messages already in the GRIB cache are not downloaded again
+  cache = GribCache(CACHE_DIR, CACHE_MAX_BYTES) if CACHE_DIR else None
+  download_subset(open_source(SOURCE_DIR), run_time, VARIABLE, MIN_LEVEL, MAX_LEVEL, file_name, cache, ("hrrr", "prs", run_time, 0))
 
 def extract():
   # Define the date and forecast hour
   date = DATE
+  hours = [(date, time) for time in range(START_TIME, END_TIME)]
+
+  # hours whose outputs are all in the manifest are skipped, unless they were
+  # written with other settings (the same as multi_extract.py's for the same output)
+  settings = {"region": REGION, "encoding": VTI_ENCODING}
+  output_settings = {VARIABLE: {"levels": (MIN_LEVEL, MAX_LEVEL)}}
+  for field in DERIVED_FIELDS:
+    output_settings[f"{VARIABLE}_{field}"] = {"levels": (MIN_LEVEL, MAX_LEVEL), "derived_threshold": DERIVED_THRESHOLD}
+  manifest = IngestManifest(MANIFEST_FILE, MANIFEST_VERIFY, settings, output_settings) if MANIFEST_FILE else None
+  if manifest is not None:
+    hours = manifest.pending([VARIABLE] + [f"{VARIABLE}_{field}" for field in DERIVED_FIELDS], hours)
+
+  if WATCH:
+    watch(hours, available, lambda ready: ingest(ready, manifest), POLL_SECONDS, WATCH_ATTEMPTS)
+  else:
+    ingest(hours, manifest)
+
+def ingest(hours, manifest):
+  # returns the hours that failed
+  on_converted = manifest.record if manifest is not None else None
+
+  # overlap downloads of later hours with decoding of earlier ones
+  if PIPELINE:
+    return run_pipeline(hours, download, convert, GRIB_FILE_PATH, DOWNLOAD_WORKERS, CONVERT_WORKERS, on_converted)
+
+  failed = []
+  for date, time in hours:
+    try:
+      download(date, time, GRIB_FILE_PATH)
 
-  for time in range(START_TIME, END_TIME):
-    run_time = pd.Timestamp(f"{date} {time}:00")
-    H = Herbie(run_time, model="hrrr", product="prs", fxx=0)
-
-    records = H.inventory("HGT")
-    print(records.head(10))  # Print the first 10 records
-
-    # Get the remote GRIB2 file URL
-    grib_url = H.grib
-    print(grib_url)
-
-    # Stream the file to a temporary location
-    response = requests.get(grib_url, stream=True)
-    response.raise_for_status()
-
-    # Save the file locally
-    with open(GRIB_FILE_PATH, "wb") as f:
-      f.write(response.content)
-
-    # extract VARIABLE 3d array
-    convert(GRIB_FILE_PATH, date, time)
+      # extract VARIABLE 3d array
+      outputs = convert(GRIB_FILE_PATH, date, time)
+      if manifest is not None:
+        manifest.record(date, time, outputs)
+    except Exception as e:
+      print(f"Failed {date} {time:02d}:00: {e}")
+      failed.append((date, time))
 
-  os.remove(GRIB_FILE_PATH)
+  if os.path.exists(GRIB_FILE_PATH):
+    os.remove(GRIB_FILE_PATH)
+  return failed
 
 
 def convert(file_name, date, time):
+  # returns the (output name, file name) written
   # Read GRIB2 Data
   grib_file = file_name 
   print(f"{VARIABLE}")
@@ -62,46 +131,67 @@ def convert(file_name, date, time):
   # Open the GRIB2 file
   grbs = pygrib.open(grib_file)
   temp_msgs = grbs.select(name={VARIABLE}, typeOfLevel='isobaricInhPa')
-  temp_msgs = [grb for grb in temp_msgs if 400 <= grb.level <= 1000]
+  temp_msgs = [grb for grb in temp_msgs if MIN_LEVEL <= grb.level <= MAX_LEVEL]
   temp_msgs.sort(key=lambda grb: grb.level)
   grbs.close()
 
   # Initialize array with shape (num_levels, y, x)
-  # Prepare array dimensions
+  # Prepare array dimensions from the message metadata (and REGION), no need to decode a level for it
   num_levels = len(temp_msgs)
-  ny, nx = temp_msgs[0].values.shape
-  temperature_3d = np.zeros((num_levels, ny, nx), dtype=np.float32)
-
-  print(enumerate(temp_msgs))
-  
-  # Fill the array
-  for i, grb in enumerate(temp_msgs):
-    try:
-      print(f"Reading level {grb.level} hPa ({i + 1}/{num_levels})")
-      temperature_3d[num_levels-i-1, :, :] = grb.values
-    except Exception as e:
-      print(f"Error at level {grb.level} hPa: {e}")
-
-  # Convert to vtkImageData ===
-  nz, ny, nx = temperature_3d.shape 
-
-  image_data = vtk.vtkImageData()
-  image_data.SetDimensions(nx, ny, nz) 
-  image_data.SetSpacing(1.0, 1.0, 1.0) 
-  image_data.SetOrigin(0.0, 0.0, 0.0)
-
-  temperature_flat = temperature_3d.ravel(order="C")
-  vtk_array = numpy_to_vtk(num_array=temperature_flat, deep=True, array_type=vtk.VTK_FLOAT)
-  vtk_array.SetName(f"{VARIABLE}")
-  image_data.GetPointData().SetScalars(vtk_array)
-
-  # Write to .vti file ===
-  writer = vtk.vtkXMLImageDataWriter()
-  writer.SetFileName(f"{VARIABLE}_{date}_{time:02d}.vti")
-  writer.SetInputData(image_data)
-  writer.Write()
-
-  print(f"Successfully saved temperature volume as '{VARIABLE}.vti'")
+  rows, cols = region_slices(REGION, temp_msgs[0])
+  ny, nx = rows.stop - rows.start, cols.stop - cols.start
+  shape = (num_levels, ny, nx)
+  origin = region_origin(rows, cols)
+
+  # the time-series volume stores must match this run (timesteps, grid, REGION)
+  # before anything of the hour is decoded or written
+  labels = [f"{date}_{t:02d}" for t in range(START_TIME, END_TIME)]
+  if VOLUME_STORE:
+    open_store(f"{VARIABLE}_{date}{STORE_EXTENSION}", VARIABLE, labels, shape, origin=origin)
+    for field in DERIVED_FIELDS:
+      open_store(f"{VARIABLE}_{field}_{date}{STORE_EXTENSION}", f"{VARIABLE}_{field}", labels, (1, ny, nx), origin=origin)
+
+  def write_outputs(temperature_3d):
+    output_filename = f"{VARIABLE}_{date}_{time:02d}.vti"
+    write_volume(temperature_3d, VARIABLE, output_filename, VTI_ENCODING, origin)
+
+    # Also add the hour to the variable's time-series volume store
+    if VOLUME_STORE:
+      write_timestep(f"{VARIABLE}_{date}{STORE_EXTENSION}", VARIABLE, labels, time - START_TIME, temperature_3d,
+                     origin=origin)
+    outputs = [(VARIABLE, output_filename)]
+
+    # 2D fields reduced from the volume while it is still in memory
+    pressures = [grb.level for grb in reversed(temp_msgs)]
+    for field, values_2d in derive_fields(temperature_3d, pressures, DERIVED_FIELDS, DERIVED_THRESHOLD).items():
+      name = f"{VARIABLE}_{field}"
+      field_filename = f"{name}_{date}_{time:02d}.vti"
+      write_vti(values_2d[np.newaxis], name, field_filename, VTI_ENCODING, origin)
+      print(f"Saved derived field: {field_filename}")
+      if VOLUME_STORE:
+        write_timestep(f"{name}_{date}{STORE_EXTENSION}", name, labels, time - START_TIME, values_2d[np.newaxis],
+                       origin=origin)
+      outputs.append((name, field_filename))
+    return outputs
+
+  # Fill the array, one decode job per level
+  levels = [(grb.level, (grib_file, grb.messagenumber, rows, cols)) for grb in temp_msgs]
+  return stack_levels(shape, decode_level, levels, write_outputs, DECODE_WORKERS)
+
+
+def decode_level(file_name, message_number, rows, cols):
+  grbs = pygrib.open(file_name)
+  try:
+    return grbs.message(message_number).values[rows, cols]
+  finally:
+    grbs.close()
+
+
+def write_volume(volume_3d, variable, file_name, encoding=None, origin=(0.0, 0.0, 0.0)):
+  # Convert to vtkImageData and write to .vti file ===
+  write_vti(volume_3d, f"{variable}", file_name, encoding, origin)
+
+  print(f"Successfully saved {variable} volume as '{file_name}'")
 
 
 if __name__ == '__main__':
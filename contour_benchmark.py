@@ -0,0 +1,65 @@
+import argparse
+import time
+import vtk
+from atmosphere_vis import CONTOUR_BACKENDS, make_variable_contour_filters, make_brick_contour_filters, timestep_loaders
+from brick_index import BrickIndex
+
+'''
+Times every isosurface backend of atmosphere_vis.py on a folder of volumes and
+reports wall time and triangles per second, on whole volumes and, with --bricks,
+on only the bricks of a min/max index that contain the isovalue.
+
+Usage: python contour_benchmark.py [--folder <folder or .vstore>] [--isovalue <value>]
+                                   [--threads <n>] [--repeat <n>] [--no-normals] [--no-merge]
+                                   [--bricks <size>]
+'''
+
+def benchmark(folder, isovalue, repeat, compute_normals, merge_points, brick_size):
+  volumes = [load() for load in timestep_loaders(folder)]
+  print(f"\n{len(volumes)} volumes from {folder}, isovalue {isovalue}, "
+        f"{vtk.vtkSMPTools.GetEstimatedNumberOfThreads()} threads ({vtk.vtkSMPTools.GetBackend()})")
+
+  runs = [(backend, None) for backend in CONTOUR_BACKENDS]
+  if brick_size > 0:
+    start = time.perf_counter()
+    bricks = [BrickIndex(image_data, brick_size) for image_data in volumes]
+    elapsed = time.perf_counter() - start
+    active = sum(len(index.active_bricks(isovalue)) for index in bricks)
+    print(f"brick index ({brick_size} cells): built in {elapsed:.2f} s, "
+          f"{active} of {sum(len(index) for index in bricks)} bricks active")
+    runs += [(backend, bricks) for backend in CONTOUR_BACKENDS]
+
+  print(f"\n{'backend':<32}{'wall s':>10}{'s/volume':>10}{'triangles':>12}{'points':>12}{'Mtri/s':>10}")
+  for backend, bricks in runs:
+    best_time = None
+    for _ in range(repeat):
+      triangles = points = 0
+      start = time.perf_counter()
+      for i, image_data in enumerate(volumes):
+        if bricks is None:
+          output = make_variable_contour_filters(image_data, isovalue, backend, compute_normals, merge_points).GetOutput()
+        else:
+          output = make_brick_contour_filters(image_data, bricks[i], isovalue, backend, compute_normals, merge_points).GetOutput()
+        triangles += output.GetNumberOfPolys()
+        points += output.GetNumberOfPoints()
+      elapsed = time.perf_counter() - start
+      best_time = elapsed if best_time is None else min(best_time, elapsed)
+
+    label = backend if bricks is None else backend + " bricks"
+    print(f"{label:<32}{best_time:>10.2f}{best_time / len(volumes):>10.2f}{triangles:>12}{points:>12}"
+          f"{triangles / best_time / 1e6:>10.2f}")
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--folder', type=str, default='clm_2025-04-08', help='folder of .vti volumes (or .vstore file)')
+  parser.add_argument('--isovalue', type=float, default=0.0001, help='isovalue to extract')
+  parser.add_argument('--threads', type=int, default=0, help='threads for the multithreaded filters (0 = all cores)')
+  parser.add_argument('--repeat', type=int, default=1, help='number of runs to take the best time of')
+  parser.add_argument('--no-normals', action='store_true', help='skip computing normals')
+  parser.add_argument('--no-merge', action='store_true', help='skip merging duplicate points (only affects marching-cubes)')
+  parser.add_argument('--bricks', type=int, default=32, help='brick size (cells) of the min/max index, 0 skips the brick runs')
+  args = parser.parse_args()
+
+  vtk.vtkSMPTools.SetBackend('STDThread')
+  vtk.vtkSMPTools.Initialize(args.threads)
+  benchmark(args.folder, args.isovalue, args.repeat, not args.no_normals, not args.no_merge, args.bricks)
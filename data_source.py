@@ -0,0 +1,139 @@
+import os
+import threading
+import time as clock
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from herbie import Herbie
+
+'''
+Where the HRRR GRIB2 files are read from. grib_fetch.py finds an hour's file
+and its .idx inventory through a source and reads only the byte ranges of the
+messages it needs:
+  RemoteSource - the public archive (found with Herbie) over HTTP, through one
+                 pooled keep-alive session with timeouts and retries with backoff.
+                 Several ranges of a file are fetched in parallel.
+  LocalSource  - a copy of the archive on local disk or a mirror mount (e.g. NFS),
+                 laid out like the buckets:
+                   <root>/hrrr.20250407/conus/hrrr.t03z.wrfprsf00.grib2 (and .grib2.idx)
+
+open_source() returns one shared source per location, so every download thread
+of a run reuses the same connections.
+'''
+
+# bytes handed over at a time while streaming a range
+CHUNK_SIZE = 1024 * 1024
+
+# errors of a response body that breaks off, after which the read is resumed
+BODY_ERRORS = (requests.ConnectionError, requests.exceptions.ChunkedEncodingError)
+
+def local_source_path(source_dir, date, time):
+  # a local copy of the HRRR archive, laid out like the NOMADS/AWS buckets:
+  # source_dir/hrrr.20250407/conus/hrrr.t03z.wrfprsf00.grib2
+  return os.path.join(source_dir, f"hrrr.{date.replace('-', '')}", "conus", f"hrrr.t{time:02d}z.wrfprsf00.grib2")
+
+class RemoteSource:
+  # timeout is (connect, read) in seconds, a failed request or a body that breaks off
+  # is retried up to retries times, waiting about backoff * 2^attempt seconds in between
+  def __init__(self, timeout=(10, 60), retries=5, backoff=1.0, range_workers=4):
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.range_workers = range_workers
+
+    # failed connections, timeouts waiting for the response and 429/5xx responses are
+    # only retried by urllib3 (before any data arrives), the loops in read_index and
+    # read_range only resume bodies that break off later
+    retry = Retry(total=None, connect=retries, read=retries, status=retries, other=0,
+                  backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(["GET", "HEAD"]))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4 * range_workers, max_retries=retry)
+    self.session = requests.Session()
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+
+  def locate(self, run_time):
+    # (grib_url, idx_url) of an analysis hour, None where it is not published
+    H = Herbie(run_time, model="hrrr", product="prs", fxx=0)
+    print(H.grib)
+    return H.grib, H.idx
+
+  def available(self, run_time):
+    H = Herbie(run_time, model="hrrr", product="prs", fxx=0, verbose=False)
+    return H.grib is not None and H.idx is not None
+
+  def retry_wait(self, attempt, error, message):
+    if attempt == self.retries:
+      raise error
+    delay = self.backoff * 2 ** attempt
+    print(f"{message} ({error}), retrying in {delay:.1f} s")
+    clock.sleep(delay)
+
+  def read_index(self, idx_url):
+    for attempt in range(self.retries + 1):
+      with self.session.get(idx_url, stream=True, timeout=self.timeout) as response:
+        response.raise_for_status()
+        try:
+          return response.text
+        except BODY_ERRORS as e:
+          self.retry_wait(attempt, e, f"Reading {idx_url} broke off")
+
+  def read_range(self, grib_url, start, end):
+    # yields bytes start..end (inclusive, None runs to the end of the file) in chunks
+    position = start
+    end_str = "" if end is None else str(end)
+    for attempt in range(self.retries + 1):
+      with self.session.get(grib_url, headers={"Range": f"bytes={position}-{end_str}"}, stream=True,
+                            timeout=self.timeout) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+          raise RuntimeError(f"Server ignored byte range request for {grib_url}")
+        try:
+          for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            position += len(chunk)
+            yield chunk
+          return
+        except BODY_ERRORS as e:
+          self.retry_wait(attempt, e, f"Reading {grib_url} broke off at byte {position}")
+
+class LocalSource:
+  def __init__(self, root, range_workers=1):
+    self.root = root
+    self.range_workers = range_workers
+
+  def locate(self, run_time):
+    grib_path = local_source_path(self.root, run_time.strftime("%Y-%m-%d"), run_time.hour)
+    if not os.path.exists(grib_path):
+      return None, None
+    # without an inventory the whole file is copied
+    idx_path = grib_path + ".idx"
+    return grib_path, idx_path if os.path.exists(idx_path) else None
+
+  def available(self, run_time):
+    return self.locate(run_time)[0] is not None
+
+  def read_index(self, idx_path):
+    with open(idx_path) as f:
+      return f.read()
+
+  def read_range(self, grib_path, start, end):
+    with open(grib_path, "rb") as f:
+      f.seek(start)
+      remaining = None if end is None else end - start + 1
+      while remaining is None or remaining > 0:
+        chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+        if not chunk:
+          break
+        if remaining is not None:
+          remaining -= len(chunk)
+        yield chunk
+
+_sources = {}
+_lock = threading.Lock()
+
+def open_source(source_dir=None):
+  # LocalSource for a mirror directory, RemoteSource for None
+  with _lock:
+    if source_dir not in _sources:
+      _sources[source_dir] = LocalSource(source_dir) if source_dir else RemoteSource()
+    return _sources[source_dir]
@@ -0,0 +1,63 @@
+import numpy as np
+
+'''
+2D fields derived from a (nz, ny, nx) volume of pressure levels, computed by
+combo_grab_volume.convert while the volume is in memory and written as
+single-layer .vti files (like the pressure layers), so atmosphere_vis.py --field
+can show them as one surface instead of contouring the whole volume:
+  top_index    - highest level (z index, 0 = highest pressure) with a value above the
+                 threshold, -1 where the column has none (e.g. cloud top)
+  base_index   - lowest level above the threshold, -1 where there is none (cloud base)
+  top_pressure - pressure (hPa) of top_index, 0 where there is none
+  column_max   - largest value of the column
+  column_total - vertical integral of the value over pressure, sum(value * dp) / g.
+                 For a mixing ratio (kg/kg) it is the column total in kg/m^2
+                 (e.g. integrated cloud water)
+
+Levels are given as their pressures (hPa) in z order, as stacked by
+combo_grab_volume (highest pressure at z = 0).
+'''
+
+GRAVITY = 9.80665
+
+def level_thickness(pressures):
+  # pressure thickness (Pa) each level stands for, half way to its neighbours
+  pressures = np.asarray(pressures, dtype=np.float64) * 100.0
+  if pressures.size < 2:
+    return np.zeros_like(pressures)
+  edges = np.concatenate(([pressures[0]], (pressures[1:] + pressures[:-1]) / 2, [pressures[-1]]))
+  return np.abs(np.diff(edges))
+
+def top_index(volume_3d, pressures, threshold):
+  above = volume_3d > threshold
+  nz = volume_3d.shape[0]
+  return np.where(above.any(axis=0), nz - 1 - np.argmax(above[::-1], axis=0), -1)
+
+def base_index(volume_3d, pressures, threshold):
+  above = volume_3d > threshold
+  return np.where(above.any(axis=0), np.argmax(above, axis=0), -1)
+
+def top_pressure(volume_3d, pressures, threshold):
+  index = top_index(volume_3d, pressures, threshold)
+  return np.where(index >= 0, np.asarray(pressures, dtype=np.float32)[index], 0)
+
+def column_max(volume_3d, pressures, threshold):
+  return volume_3d.max(axis=0)
+
+def column_total(volume_3d, pressures, threshold):
+  weights = (level_thickness(pressures) / GRAVITY).astype(np.float32)
+  return np.tensordot(weights, volume_3d, axes=1)
+
+DERIVED_FIELDS = {
+  "top_index": top_index,
+  "base_index": base_index,
+  "top_pressure": top_pressure,
+  "column_max": column_max,
+  "column_total": column_total,
+}
+
+def derive_fields(volume_3d, pressures, names, threshold=0.0):
+  # {name: (ny, nx) float32 array} of the named fields
+  if len(pressures) != volume_3d.shape[0]:
+    raise ValueError(f"{len(pressures)} pressures given for {volume_3d.shape[0]} levels")
+  return {name: DERIVED_FIELDS[name](volume_3d, pressures, threshold).astype(np.float32) for name in names}
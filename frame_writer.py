@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
+import re
+import threading
+import vtk
+from stage_timer import timer
+
+'''
+Saves rendered frames as numbered PNG files without blocking the caller. The
+pixels are read from the render window on the calling (GUI) thread, then PNG
+compression and writing run on a pool of background threads, so several
+screenshots of a session are written in parallel. Numbering continues after
+the highest existing file, so earlier screenshots are never overwritten.
+
+A scale above 1 renders the window in scale x scale tiles (vtkWindowToImageFilter)
+for print resolution output.
+'''
+
+class FrameWriter:
+  def __init__(self, directory="", prefix="Screenshot", workers=4, on_saved=None):
+    # on_saved(file_name) is called from a background thread once a file is written
+    self.directory = directory
+    self.prefix = prefix
+    self.on_saved = on_saved
+    self.pool = ThreadPoolExecutor(max_workers=workers)
+    self.pending = set()
+    self.lock = threading.Lock()
+    self.next_index = self.first_free_index()
+
+  def first_free_index(self):
+    pattern = re.compile(re.escape(self.prefix) + r"(\d+)\.png$")
+    indices = [int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory or ".")) if match]
+    return max(indices, default=-1) + 1
+
+  def reserve_file_name(self):
+    with self.lock:
+      while True:
+        file_name = os.path.join(self.directory, self.prefix + str(self.next_index).zfill(5) + ".png")
+        self.next_index += 1
+        if not os.path.exists(file_name):
+          return file_name
+
+  def capture(self, window, scale=1):
+    with timer.stage("capture"):
+      window.Render()
+      image = vtk.vtkWindowToImageFilter()
+      image.SetInput(window)
+      image.SetScale(scale)
+      image.ReadFrontBufferOff()
+      image.Update()
+
+    file_name = self.reserve_file_name()
+    future = self.pool.submit(self.write, image.GetOutput(), file_name)
+    with self.lock:
+      self.pending.add(future)
+    future.add_done_callback(self.finished)
+    return file_name
+
+  def write(self, pixels, file_name):
+    # written under a temporary name so a half written PNG is never picked up
+    temp_name = file_name + ".part"
+    with timer.stage("png write"):
+      png_writer = vtk.vtkPNGWriter()
+      png_writer.SetInputData(pixels)
+      png_writer.SetFileName(temp_name)
+      png_writer.Write()
+    os.replace(temp_name, file_name)
+    return file_name
+
+  def finished(self, future):
+    with self.lock:
+      self.pending.discard(future)
+    if future.exception() is not None:
+      print(f"Error saving screenshot: {future.exception()}")
+    elif self.on_saved is not None:
+      self.on_saved(future.result())
+
+  def flush(self):
+    # wait for every screenshot taken so far to be written
+    with self.lock:
+      pending = list(self.pending)
+    wait(pending)
+
+  def close(self):
+    self.pool.shutdown(wait=True)
@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+import itertools
+import os
+import shutil
+import threading
+try:
+  import fcntl
+except ImportError:
+  # Windows, the cache is only locked between the threads of one process
+  fcntl = None
+
+'''
+Persistent on-disk cache of downloaded GRIB2 messages. Each (model, product,
+run time, fxx) gets its own entry directory holding the .idx inventory and one
+file per message, so extracting another variable for the same cycle only
+downloads the messages that are not cached yet. Entries are evicted least
+recently used first once the cache grows past its byte budget.
+
+An entry is pinned while a download reads or writes it (a ".pin-<pid>-<n>" file
+in the entry, so other processes sharing the cache see it too) and eviction
+skips pinned entries. Pinning and eviction hold a file lock on root/.lock.
+'''
+
+_lock = threading.Lock()
+_pins = itertools.count()
+
+def process_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except OSError:
+    pass
+  return True
+
+class GribCache:
+  def __init__(self, root, max_bytes):
+    self.root = root
+    self.max_bytes = max_bytes
+
+  @contextmanager
+  def locked(self):
+    # held across the threads of this process and, where fcntl exists, across processes
+    with _lock:
+      os.makedirs(self.root, exist_ok=True)
+      with open(os.path.join(self.root, ".lock"), "a") as lock_file:
+        if fcntl is not None:
+          fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+          yield
+        finally:
+          if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def entry(self, model, product, run_time, fxx):
+    path = os.path.join(self.root, model, product, run_time.strftime("%Y%m%d%H"), f"f{fxx:02d}")
+    os.makedirs(path, exist_ok=True)
+    # mark as most recently used
+    os.utime(path)
+    return path
+
+  @contextmanager
+  def use(self, model, product, run_time, fxx):
+    # the entry's path, pinned so evict() leaves it alone until the block ends
+    with self.locked():
+      path = self.entry(model, product, run_time, fxx)
+      pin = os.path.join(path, f".pin-{os.getpid()}-{next(_pins)}")
+      open(pin, "w").close()
+    try:
+      yield path
+    finally:
+      with self.locked():
+        os.remove(pin)
+
+  def pinned(self, entry):
+    # pins left behind by processes that died don't count
+    for name in os.listdir(entry):
+      if name.startswith(".pin-") and process_alive(int(name.split("-")[1])):
+        return True
+    return False
+
+  def index_path(self, entry):
+    return os.path.join(entry, "index.idx")
+
+  def message_path(self, entry, record):
+    return os.path.join(entry, f"{record['start']}.grib2")
+
+  def has_message(self, entry, record):
+    return os.path.exists(self.message_path(entry, record))
+
+  def assemble(self, entry, records, file_name):
+    # concatenate the cached messages into a single GRIB2 file for pygrib
+    with open(file_name, "wb") as f:
+      for record in records:
+        with open(self.message_path(entry, record), "rb") as message:
+          shutil.copyfileobj(message, f)
+      os.utime(entry)
+
+  def entries(self):
+    # every entry directory is root/model/product/run_time/fxx
+    found = []
+    for dir_path, dir_names, file_names in os.walk(self.root):
+      if os.path.relpath(dir_path, self.root).count(os.sep) == 3:
+        size = sum(os.path.getsize(os.path.join(dir_path, name)) for name in file_names)
+        found.append((os.path.getmtime(dir_path), size, dir_path))
+        dir_names[:] = []
+    return found
+
+  def evict(self):
+    with self.locked():
+      entries = sorted(self.entries())
+      total = sum(size for _, size, _ in entries)
+      for _, size, path in entries:
+        if total <= self.max_bytes:
+          break
+        if self.pinned(path):
+          continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        print(f"Evicted {path} from GRIB cache ({size / 1e6:.1f} MB)")
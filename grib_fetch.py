@@ -0,0 +1,234 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Helper functions to download only the GRIB2 messages that are needed from a
+remote file, using its .idx inventory and HTTP Range requests. The file is
+read through a source from data_source.py (the remote archive or a local
+mirror), the byte ranges of an hour are fetched source.range_workers at a time.
+'''
+
+# .idx inventories use the wgrib2 short names, pygrib uses the long names
+GRIB_SHORT_NAMES = {
+  "Temperature": "TMP",
+  "Cloud mixing ratio": "CLMR",
+  "Geopotential height": "HGT",
+  "Relative humidity": "RH",
+  "Vertical velocity": "VVEL",
+  "Absolute vorticity": "ABSV",
+  "Dew point temperature": "DPT",
+  "Graupel (snow pellets)": "GRLE",
+}
+
+def parse_index(text):
+  # each line looks like "12:3456789:d=2025040800:TMP:500 mb:anl:"
+  records = []
+  for line in text.splitlines():
+    fields = line.strip().split(":")
+    if len(fields) < 5:
+      continue
+    records.append({
+      "message": fields[0],
+      "start": int(fields[1]),
+      "end": None,
+      "variable": fields[3],
+      "level": fields[4],
+    })
+
+  # a message ends where the next one starts, the last one runs to end of file
+  starts = sorted({record["start"] for record in records})
+  next_start = dict(zip(starts, starts[1:]))
+  for record in records:
+    if record["start"] in next_start:
+      record["end"] = next_start[record["start"]] - 1
+
+  return records
+
+def fetch_index(source, idx_url):
+  if idx_url is None:
+    raise ValueError("No .idx inventory available for this GRIB2 file")
+  return source.read_index(idx_url)
+
+def read_index(source, idx_url):
+  return parse_index(fetch_index(source, idx_url))
+
+def pressure_level(record):
+  # "500 mb" -> 500, anything that isn't an isobaric level -> None
+  value, _, unit = record["level"].partition(" ")
+  if unit != "mb":
+    return None
+  try:
+    return int(value)
+  except ValueError:
+    return None
+
+def select_messages(records, variable, min_level, max_level):
+  short_name = GRIB_SHORT_NAMES.get(variable, variable)
+  selected = []
+  for record in records:
+    level = pressure_level(record)
+    if record["variable"] == short_name and level is not None and min_level <= level <= max_level:
+      selected.append(record)
+  return selected
+
+def unique_messages(records):
+  # sub-messages share a start byte, so only keep each message once
+  messages = {record["start"]: record for record in records}
+  return [messages[start] for start in sorted(messages)]
+
+def byte_ranges(records):
+  # merge messages that sit next to each other in the file into one request
+  ranges = []
+  for record in unique_messages(records):
+    if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 == record["start"]:
+      ranges[-1] = (ranges[-1][0], record["end"])
+    else:
+      ranges.append((record["start"], record["end"]))
+  return ranges
+
+def part_path(path):
+  # temp file of one writer, so threads and processes sharing a cache don't clobber each other
+  return f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+
+def range_size(start, end):
+  return None if end is None else end - start + 1
+
+def stream_range(source, grib_url, start, end, outputs):
+  # outputs is a list of (file, number of bytes) that the range is split across,
+  # None as the number of bytes takes everything that is left
+  total_bytes = 0
+  chunks = source.read_range(grib_url, start, end)
+  try:
+    buffer = memoryview(b"")
+    for f, size in outputs:
+      remaining = size
+      while remaining is None or remaining > 0:
+        if not buffer:
+          buffer = memoryview(next(chunks, b""))
+          if not buffer:
+            break
+        piece = buffer if remaining is None else buffer[:remaining]
+        f.write(piece)
+        buffer = buffer[len(piece):]
+        total_bytes += len(piece)
+        if remaining is not None:
+          remaining -= len(piece)
+  finally:
+    chunks.close()
+
+  size = range_size(start, end)
+  if size is not None and total_bytes != size:
+    raise RuntimeError(f"Got {total_bytes} of {size} bytes at {start} from {grib_url}")
+  return total_bytes
+
+def fetch_all(source, tasks):
+  # runs the tasks source.range_workers at a time, returns the sum of their results
+  if len(tasks) <= 1 or source.range_workers <= 1:
+    return sum(task() for task in tasks)
+  with ThreadPoolExecutor(max_workers=source.range_workers) as pool:
+    return sum(pool.map(lambda task: task(), tasks))
+
+def download_ranges(source, grib_url, ranges, file_name):
+  # every range is written at its own offset of the file, so they can arrive in any
+  # order. Only the last range of a file can run to the end (size None)
+  offsets = [0]
+  for start, end in ranges[:-1]:
+    offsets.append(offsets[-1] + range_size(start, end))
+
+  def fetch(offset, start, end):
+    with open(file_name, "r+b") as f:
+      f.seek(offset)
+      return stream_range(source, grib_url, start, end, [(f, None)])
+
+  open(file_name, "wb").close()
+  return fetch_all(source, [lambda offset=offset, start=start, end=end: fetch(offset, start, end)
+                            for offset, (start, end) in zip(offsets, ranges)])
+
+def download_to_cache(source, grib_url, records, cache, entry):
+  # stream each byte range straight into one cache file per message
+  def fetch(start, end):
+    group = [record for record in unique_messages(records)
+             if start <= record["start"] and (end is None or record["start"] <= end)]
+    paths = [cache.message_path(entry, record) for record in group]
+    files = [open(part_path(path), "wb") for path in paths]
+    try:
+      sizes = [range_size(record["start"], record["end"]) for record in group]
+      total_bytes = stream_range(source, grib_url, start, end, list(zip(files, sizes)))
+    finally:
+      for f in files:
+        f.close()
+
+    for path in paths:
+      os.replace(part_path(path), path)
+    return total_bytes
+
+  return fetch_all(source, [lambda start=start, end=end: fetch(start, end) for start, end in byte_ranges(records)])
+
+def download_subset(source, run_time, variable, min_level, max_level, file_name, cache=None, cache_key=None):
+  return download_messages(source, run_time, [(variable, min_level, max_level)], file_name, cache, cache_key)
+
+def download_messages(source, run_time, selections, file_name, cache=None, cache_key=None):
+  # selections is a list of (variable, min_level, max_level), messages that are
+  # wanted by more than one selection are only downloaded once.
+  # The file of run_time is only looked up in the source (source.locate) when
+  # something actually has to be read from it, with a cache that may be never
+  names = ", ".join(sorted({variable for variable, _, _ in selections}))
+
+  located = []
+  def locate():
+    if not located:
+      grib_url, idx_url = source.locate(run_time)
+      if grib_url is None:
+        raise FileNotFoundError(f"No GRIB2 file for {run_time} in {type(source).__name__}")
+      located.extend((grib_url, idx_url))
+    return located
+
+  def select(index_records, index_name):
+    records = []
+    for variable, min_level, max_level in selections:
+      selected = select_messages(index_records, variable, min_level, max_level)
+      if not selected:
+        raise ValueError(f"No messages for {variable} between {min_level} and {max_level} hPa in {index_name}")
+      records += selected
+    return unique_messages(records)
+
+  def download_direct():
+    grib_url, idx_url = locate()
+    if idx_url is None:
+      total_bytes = download_ranges(source, grib_url, [(0, None)], file_name)
+      print(f"Copied all of {grib_url} ({total_bytes / 1e6:.1f} MB), it has no .idx inventory")
+      return None
+    records = select(read_index(source, idx_url), idx_url)
+    total_bytes = download_ranges(source, grib_url, byte_ranges(records), file_name)
+    print(f"Downloaded {len(records)} messages ({total_bytes / 1e6:.1f} MB) of {names}")
+    return records
+
+  if cache is None:
+    return download_direct()
+
+  # the entry is pinned until the file is assembled, so other downloads can't evict it
+  with cache.use(*cache_key) as entry:
+    # without a cached or published .idx inventory (a mirror without them) the whole
+    # file is copied and not cached
+    index_path = cache.index_path(entry)
+    if not os.path.exists(index_path):
+      if locate()[1] is None:
+        return download_direct()
+      with open(part_path(index_path), "w") as f:
+        f.write(fetch_index(source, locate()[1]))
+      os.replace(part_path(index_path), index_path)
+
+    with open(index_path) as f:
+      records = select(parse_index(f.read()), index_path)
+
+    missing = [record for record in records if not cache.has_message(entry, record)]
+    total_bytes = 0
+    if missing:
+      total_bytes = download_to_cache(source, locate()[0], missing, cache, entry)
+    print(f"Downloaded {len(missing)} messages ({total_bytes / 1e6:.1f} MB) of {names}, "
+          f"{len(records) - len(missing)} from cache")
+
+    cache.assemble(entry, records, file_name)
+  cache.evict()
+  return records
@@ -0,0 +1,53 @@
+import numpy as np
+
+'''
+Region of interest on the HRRR grid, used by the extract scripts to write only
+part of each field. A region is one of:
+  None                                          - the whole grid
+  {"x": (x0, x1), "y": (y0, y1)}                - grid indices, end exclusive
+  {"lat": (south, north), "lon": (west, east)}  - degrees (west negative), the
+                                                  smallest grid box holding every
+                                                  point inside the lat/lon box
+
+Grid point (x, y) of the full grid sits at (x, y) on the map plane of
+atmosphere_vis.py, so a region is written with origin (x0, y0, 0) to line up.
+'''
+
+# lat/lon boxes resolved so far, (region, Nx, Ny) -> (rows, cols)
+_resolved = {}
+
+def region_key(region):
+  return tuple(sorted((name, tuple(bounds)) for name, bounds in region.items()))
+
+def region_slices(region, grb):
+  # (rows, cols) slices of the region on the grid of GRIB message grb
+  ny, nx = grb['Ny'], grb['Nx']
+  if region is None:
+    return slice(0, ny), slice(0, nx)
+
+  if "x" in region:
+    x0, x1 = region["x"]
+    y0, y1 = region["y"]
+    rows, cols = slice(max(0, y0), min(ny, y1)), slice(max(0, x0), min(nx, x1))
+  else:
+    key = (region_key(region), nx, ny)
+    if key not in _resolved:
+      lats, lons = grb.latlons()
+      lons = np.where(lons > 180.0, lons - 360.0, lons)
+      south, north = region["lat"]
+      west, east = region["lon"]
+      inside = (lats >= south) & (lats <= north) & (lons >= west) & (lons <= east)
+      y_inside = np.flatnonzero(inside.any(axis=1))
+      x_inside = np.flatnonzero(inside.any(axis=0))
+      if y_inside.size == 0:
+        raise ValueError(f"No grid points inside region {region}")
+      _resolved[key] = (slice(int(y_inside[0]), int(y_inside[-1]) + 1),
+                        slice(int(x_inside[0]), int(x_inside[-1]) + 1))
+    rows, cols = _resolved[key]
+
+  if rows.start >= rows.stop or cols.start >= cols.stop:
+    raise ValueError(f"Region {region} is outside the {nx} x {ny} grid")
+  return rows, cols
+
+def region_origin(rows, cols):
+  return (float(cols.start), float(rows.start), 0.0)
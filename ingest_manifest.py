@@ -0,0 +1,118 @@
+from contextlib import contextmanager
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+try:
+  import fcntl
+except ImportError:
+  # Windows, saves are only locked between the threads of one process
+  fcntl = None
+
+'''
+Record of the outputs an ingest has finished, so rerunning an extract script
+skips the hours that are done and only redoes the ones that failed or never
+ran. Every output is keyed by (output name, date, hour) and kept with its file,
+size, SHA-256 checksum and the settings it was written with (e.g. REGION and
+VTI_ENCODING) in a JSON file:
+
+  {"Temperature|2025-04-07|03": {"file": "Temperature_2025-04-07_03.vti",
+                                 "size": 52428800, "sha256": "...",
+                                 "settings": {"region": null, "encoding": {...}},
+                                 "finished": "2025-04-07T12:00:00"}, ...}
+
+An output counts as done while its file still exists with the recorded size
+and was written with the current settings, with verify=True its checksum is
+compared as well. The settings of an output depend only on what it is (every
+script passes REGION and VTI_ENCODING, volumes add their level range), so the
+scripts sharing a manifest agree on the outputs they have in common. Saving holds a file lock on "<file>.lock", so scripts
+recording at the same time merge their entries instead of losing them.
+'''
+
+_lock = threading.Lock()
+
+def file_checksum(file_name):
+  digest = hashlib.sha256()
+  with open(file_name, "rb") as f:
+    for block in iter(lambda: f.read(1024 * 1024), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+class IngestManifest:
+  def __init__(self, file_name, verify=False, settings=None, output_settings=None):
+    # settings is what every output depends on besides the hour, output_settings
+    # {output name: settings} adds to it for single outputs (e.g. a volume's levels)
+    self.file_name = file_name
+    self.verify = verify
+    self.settings = settings
+    self.output_settings = output_settings or {}
+    self.entries = self.read()
+
+  def settings_of(self, name):
+    # as it reads back from JSON
+    settings = self.settings
+    if name in self.output_settings:
+      settings = {**(settings or {}), **self.output_settings[name]}
+    return json.loads(json.dumps(settings))
+
+  def read(self):
+    if not os.path.exists(self.file_name):
+      return {}
+    with open(self.file_name) as f:
+      return json.load(f)
+
+  def key(self, name, date, time):
+    return f"{name}|{date}|{time:02d}"
+
+  def is_done(self, name, date, time):
+    entry = self.entries.get(self.key(name, date, time))
+    if entry is None or entry.get("settings") != self.settings_of(name):
+      return False
+    if not os.path.exists(entry["file"]) or os.path.getsize(entry["file"]) != entry["size"]:
+      return False
+    return not self.verify or file_checksum(entry["file"]) == entry["sha256"]
+
+  def pending(self, names, hours):
+    # the hours that still miss one of the named outputs
+    pending = [(date, time) for date, time in hours if not all(self.is_done(name, date, time) for name in names)]
+    if len(pending) < len(hours):
+      print(f"Skipping {len(hours) - len(pending)} of {len(hours)} hours already in {self.file_name}")
+    return pending
+
+  def record(self, date, time, outputs):
+    # outputs is a list of (output name, file name) written for the hour
+    for name, file_name in outputs:
+      self.entries[self.key(name, date, time)] = {
+        "file": file_name,
+        "size": os.path.getsize(file_name),
+        "sha256": file_checksum(file_name),
+        "settings": self.settings_of(name),
+        "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+      }
+    self.save()
+
+  @contextmanager
+  def locked(self):
+    # held across the threads of this process and, where fcntl exists, across processes
+    with _lock:
+      with open(self.file_name + ".lock", "a") as lock_file:
+        if fcntl is not None:
+          fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+          yield
+        finally:
+          if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def save(self):
+    # merged with what other scripts recorded meanwhile, then replaced in one step
+    with self.locked():
+      entries = self.read()
+      entries.update(self.entries)
+      self.entries = entries
+      with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(self.file_name)),
+                                       suffix=".part", delete=False) as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+      os.replace(f.name, self.file_name)
@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import os
+import time as clock
+
+'''
+Pipelined ingest: a bounded pool of download threads feeds a pool of
+decode/convert processes so network waits and pygrib decoding overlap.
+watch() polls the source for hours that are not published yet and ingests
+them as they appear.
+'''
+
+def scratch_file_path(base_path, date, time):
+  # "temp_hrrr.grib2" -> "temp_hrrr_2025-04-08_03.grib2", one per hour
+  base, ext = os.path.splitext(base_path)
+  return f"{base}_{date}_{time:02d}{ext}"
+
+def run_pipeline(hours, download, convert, scratch_path, download_workers=4, convert_workers=2, on_converted=None):
+  # hours is a list of (date, time) pairs, download(date, time, file_name) fetches
+  # one GRIB2 file and convert(file_name, date, time) writes its outputs.
+  # on_converted(date, time, result) is called here (not in the worker) with what
+  # convert returned, e.g. to record the outputs in the ingest manifest
+  total = len(hours)
+  queue = list(enumerate(hours))
+  downloads = {}
+  converts = {}
+  errors = {}
+  next_report = 0
+
+  # at most this many hours (and scratch files) are in flight at once
+  max_in_flight = download_workers + convert_workers
+
+  with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+       ProcessPoolExecutor(max_workers=convert_workers) as convert_pool:
+    while queue or downloads or converts:
+      while queue and len(downloads) + len(converts) < max_in_flight:
+        index, (date, time) = queue.pop(0)
+        file_name = scratch_file_path(scratch_path, date, time)
+        future = download_pool.submit(download, date, time, file_name)
+        downloads[future] = (index, date, time, file_name)
+
+      done, _ = wait(list(downloads) + list(converts), return_when=FIRST_COMPLETED)
+      for future in done:
+        if future in downloads:
+          index, date, time, file_name = downloads.pop(future)
+          if future.exception() is None:
+            converts[convert_pool.submit(convert, file_name, date, time)] = (index, date, time, file_name)
+            continue
+        else:
+          index, date, time, file_name = converts.pop(future)
+          if future.exception() is None and on_converted is not None:
+            try:
+              on_converted(date, time, future.result())
+            except Exception as e:
+              errors[index] = e
+
+        errors.setdefault(index, future.exception())
+        if os.path.exists(file_name):
+          os.remove(file_name)
+
+      # report finished hours in order, even if they completed out of order
+      while next_report in errors:
+        date, time = hours[next_report]
+        if errors[next_report] is None:
+          print(f"[{next_report + 1}/{total}] Finished {date} {time:02d}:00")
+        else:
+          print(f"[{next_report + 1}/{total}] Failed {date} {time:02d}:00: {errors[next_report]}")
+        next_report += 1
+
+  failed = [hours[index] for index, error in errors.items() if error is not None]
+  if failed:
+    print(f"{len(failed)} of {total} hours failed: {failed}")
+  return failed
+
+def watch(hours, available, ingest, poll_seconds, max_attempts=3):
+  # ingests each hour once available(date, time) reports it is published, polling
+  # every poll_seconds until all are done. ingest(hours) returns the hours that
+  # failed, which are tried again on the next poll until they have failed
+  # max_attempts times. Returns the hours that were given up on
+  waiting = list(hours)
+  attempts = {}
+  given_up = []
+  while waiting:
+    ready = []
+    try:
+      for date, time in waiting:
+        if available(date, time):
+          ready.append((date, time))
+    except Exception as e:
+      # e.g. the network is down, the rest is checked on the next poll
+      print(f"Checking for new hours failed: {e}")
+
+    if ready:
+      failed = ingest(ready)
+      for date, time in failed:
+        attempts[(date, time)] = attempts.get((date, time), 0) + 1
+        if attempts[(date, time)] >= max_attempts:
+          print(f"Giving up on {date} {time:02d}:00 after {max_attempts} failed attempts")
+          given_up.append((date, time))
+      waiting = [hour for hour in waiting if (hour not in ready or hour in failed) and hour not in given_up]
+    if waiting:
+      print(f"Waiting for {len(waiting)} hours, from {waiting[0][0]} {waiting[0][1]:02d}:00, polling again in {poll_seconds} s")
+      clock.sleep(poll_seconds)
+
+  if given_up:
+    print(f"{len(given_up)} of {len(hours)} hours failed {max_attempts} times and were given up: {given_up}")
+  return given_up
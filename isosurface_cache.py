@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import threading
+import vtk
+
+'''
+Persistent on-disk cache of isosurfaces. Each contour is stored as a binary
+.vtp file named after a hash of the source timestep (path + modification
+time), the isovalue and the contouring options, so re-opening the same case
+study loads the surfaces instead of recomputing them. Files are evicted least
+recently used first once the cache grows past its byte budget.
+'''
+
+_lock = threading.Lock()
+
+class IsosurfaceCache:
+  def __init__(self, root, max_bytes):
+    self.root = root
+    self.max_bytes = max_bytes
+    os.makedirs(root, exist_ok=True)
+
+  def path(self, source_key, isovalue, options):
+    key = json.dumps([source_key, repr(float(isovalue)), options], sort_keys=True)
+    return os.path.join(self.root, hashlib.sha1(key.encode()).hexdigest() + ".vtp")
+
+  def load(self, source_key, isovalue, options):
+    path = self.path(source_key, isovalue, options)
+    if not os.path.exists(path):
+      return None
+
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(path)
+    reader.Update()
+    if reader.GetErrorCode():
+      return None
+
+    # mark as most recently used
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      pass
+    return reader.GetOutput()
+
+  def save(self, source_key, isovalue, options, polydata):
+    path = self.path(source_key, isovalue, options)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(temp_path)
+    writer.SetInputData(polydata)
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.SetCompressorTypeToLZ4()
+    writer.SetHeaderTypeToUInt64()
+    writer.Write()
+    os.replace(temp_path, path)
+
+    self.evict(keep=path)
+
+  def evict(self, keep=None):
+    with _lock:
+      entries = []
+      for name in os.listdir(self.root):
+        if name.endswith(".vtp"):
+          path = os.path.join(self.root, name)
+          try:
+            entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+          except FileNotFoundError:
+            pass
+
+      entries.sort()
+      total = sum(size for _, size, _ in entries)
+      for _, size, path in entries:
+        if total <= self.max_bytes:
+          break
+        if path == keep:
+          continue
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        total -= size
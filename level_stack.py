@@ -0,0 +1,57 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+import numpy as np
+
+'''
+Stacks the pressure levels of a GRIB2 variable into one (num_levels, ny, nx)
+float32 volume, highest pressure at z = 0. The levels are read by a pool of
+processes that write them straight into a shared memory block, so nothing is
+copied back. Used by combo_grab_volume.convert (which reads the levels with
+pygrib) and timed by benchmark_suite.py, which doesn't need pygrib for it.
+'''
+
+def decode_workers(processes=1):
+  # the cores split between this many processes each running its own pool
+  return max(1, (os.cpu_count() or 1) // processes)
+
+def stack_levels(shape, read_level, levels, process, workers=1):
+  # levels is a list of (level, args) in GRIB message order (lowest pressure first),
+  # read_level(*args) returns a level's (ny, nx) values. They are stacked into a
+  # (num_levels, ny, nx) volume with the highest pressure at z = 0, which is handed to
+  # process(volume_3d) before it is freed, returns what process returns.
+  # read_level is run in up to `workers` processes, so it must be picklable
+  num_levels = shape[0]
+  shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+  try:
+    volume_3d = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    volume_3d[:] = 0
+
+    jobs = [(read_level, args, level, i, shm.name, shape, num_levels-i-1) for i, (level, args) in enumerate(levels)]
+    if workers > 1:
+      with ProcessPoolExecutor(max_workers=min(workers, num_levels)) as pool:
+        list(pool.map(fill_level, jobs))
+    else:
+      for job in jobs:
+        fill_level(job)
+
+    return process(volume_3d)
+  finally:
+    volume_3d = None
+    shm.close()
+    shm.unlink()
+
+def fill_level(job):
+  read_level, args, level, i, shm_name, shape, index = job
+
+  shm = shared_memory.SharedMemory(name=shm_name)
+  try:
+    volume_3d = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    print(f"Reading level {level} hPa ({i + 1}/{shape[0]})")
+    volume_3d[index, :, :] = read_level(*args)
+  except Exception as e:
+    # a missing level fails the hour instead of leaving zeros in the volume
+    raise RuntimeError(f"Decoding level {level} hPa failed: {e}") from e
+  finally:
+    volume_3d = None
+    shm.close()
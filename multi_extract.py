@@ -0,0 +1,191 @@
+import pandas as pd
+import numpy as np
+import pygrib  # For reading GRIB2 files
+import os
+from grib_fetch import download_messages
+from grib_cache import GribCache
+from ingest_pipeline import run_pipeline, watch
+from data_source import open_source
+from ingest_manifest import IngestManifest
+from combo_grab_volume import write_volume
+from pressure_layer_time_extract import write_layer
+from volume_store import open_store, write_timestep, STORE_EXTENSION
+from grid_region import region_slices, region_origin
+
+"""
+  Extracts several 3d variables and 2d pressure layers in one go. Each GRIB2
+  file is downloaded and opened once, and its messages are walked a single
+  time. A message needed by more than one output (e.g. the 1000 hPa
+  geopotential height for both a height volume and the pressure layer) is
+  only downloaded and decoded once.
+"""
+
+VARIABLES = ["Temperature", "Cloud mixing ratio"]
+LAYERS = [("Geopotential height", 1000)]
+GRIB_FILE_PATH = "temp_hrrr.grib2"
+DATE = "2025-04-07"
+START_TIME = 0
+END_TIME = 5
+MIN_LEVEL = 400
+MAX_LEVEL = 1000
+PIPELINE = True
+DOWNLOAD_WORKERS = 4
+CONVERT_WORKERS = 2
+CACHE_DIR = "grib_cache"
+CACHE_MAX_BYTES = 20 * 1024**3
+VOLUME_STORE = True
+# see vti_io.py for the options, storage "float16"/"uint16" trade precision for space
+VTI_ENCODING = {"data_mode": "raw", "compressor": "zlib", "level": 5, "block_size": 32768, "storage": "float32"}
+# only write part of the grid, see grid_region.py; None writes everything
+REGION = None
+# finished outputs are recorded here with their size and checksum, reruns skip
+# them and only redo the hours that failed; None disables it
+MANIFEST_FILE = "ingest_manifest.json"
+# also compare checksums (not only sizes) of recorded outputs before skipping them
+MANIFEST_VERIFY = False
+# keep polling for hours that are not published yet and ingest each as it appears
+WATCH = False
+POLL_SECONDS = 300
+# a watched hour that fails this many times is given up on (and reported)
+WATCH_ATTEMPTS = 3
+# read the GRIB2 files from a local copy of the archive (e.g. an NFS mirror) instead of
+# downloading them, see data_source.py for the layout; None downloads
+SOURCE_DIR = None
+
+def available(date, time):
+  # whether the hour has been published (or is in SOURCE_DIR)
+  return open_source(SOURCE_DIR).available(pd.Timestamp(f"{date} {time}:00"))
+
+def download(date, time, file_name):
+  run_time = pd.Timestamp(f"{date} {time}:00")
+
+  # Download the messages of every variable and layer in one file
+  selections = [(variable, MIN_LEVEL, MAX_LEVEL) for variable in VARIABLES]
+  selections += [(variable, level, level) for variable, level in LAYERS]
+  cache = GribCache(CACHE_DIR, CACHE_MAX_BYTES) if CACHE_DIR else None
+  download_messages(open_source(SOURCE_DIR), run_time, selections, file_name, cache, ("hrrr", "prs", run_time, 0))
+
+def extract():
+  # Define the date
+  date = DATE
+  hours = [(date, time) for time in range(START_TIME, END_TIME)]
+
+  # hours whose outputs are all in the manifest are skipped, unless they were
+  # written with other settings (the same as combo_grab_volume.py's volumes and
+  # pressure_layer_time_extract.py's layers)
+  settings = {"region": REGION, "encoding": VTI_ENCODING}
+  output_settings = {variable: {"levels": (MIN_LEVEL, MAX_LEVEL)} for variable in VARIABLES}
+  manifest = IngestManifest(MANIFEST_FILE, MANIFEST_VERIFY, settings, output_settings) if MANIFEST_FILE else None
+  if manifest is not None:
+    hours = manifest.pending(VARIABLES + [f"{variable}_{level}hPa" for variable, level in LAYERS], hours)
+
+  if WATCH:
+    watch(hours, available, lambda ready: ingest(ready, manifest), POLL_SECONDS, WATCH_ATTEMPTS)
+  else:
+    ingest(hours, manifest)
+
+def ingest(hours, manifest):
+  # returns the hours that failed
+  on_converted = manifest.record if manifest is not None else None
+
+  # overlap downloads of later hours with decoding of earlier ones
+  if PIPELINE:
+    return run_pipeline(hours, download, convert, GRIB_FILE_PATH, DOWNLOAD_WORKERS, CONVERT_WORKERS, on_converted)
+
+  failed = []
+  for date, time in hours:
+    try:
+      download(date, time, GRIB_FILE_PATH)
+
+      # extract every variable and layer
+      outputs = convert(GRIB_FILE_PATH, date, time)
+      if manifest is not None:
+        manifest.record(date, time, outputs)
+    except Exception as e:
+      print(f"Failed {date} {time:02d}:00: {e}")
+      failed.append((date, time))
+
+  if os.path.exists(GRIB_FILE_PATH):
+    os.remove(GRIB_FILE_PATH)
+  return failed
+
+def convert(file_name, date, time):
+  # returns the (output name, file name) of every output written
+  variables = set(VARIABLES)
+  layers = set(LAYERS)
+
+  volume_levels = {variable: {} for variable in variables}
+  layer_values = {}
+  region = None
+
+  # Walk the GRIB2 file once, decoding each wanted message a single time
+  grbs = pygrib.open(file_name)
+  for grb in grbs:
+    if grb.typeOfLevel != 'isobaricInhPa':
+      continue
+
+    in_volume = grb.name in variables and MIN_LEVEL <= grb.level <= MAX_LEVEL
+    in_layer = (grb.name, grb.level) in layers
+    if not (in_volume or in_layer):
+      continue
+
+    print(f"Reading {grb.name} at {grb.level} hPa")
+    # every message is on the same grid, so the region is resolved once
+    if region is None:
+      region = region_slices(REGION, grb)
+    rows, cols = region
+    values = grb.values[rows, cols].astype(np.float32)
+    if in_volume:
+      volume_levels[grb.name][grb.level] = values
+    if in_layer:
+      layer_values[(grb.name, grb.level)] = values
+  grbs.close()
+
+  labels = [f"{date}_{t:02d}" for t in range(START_TIME, END_TIME)]
+  outputs = []
+  origin = region_origin(*region) if region is not None else (0.0, 0.0, 0.0)
+
+  # every volume store must match this run (timesteps, grid, REGION) before any
+  # output of the hour is written
+  if VOLUME_STORE:
+    for variable in dict.fromkeys(VARIABLES):
+      levels = volume_levels[variable]
+      if levels:
+        shape = (len(levels),) + next(iter(levels.values())).shape
+        open_store(f"{variable}_{date}{STORE_EXTENSION}", variable, labels, shape, origin=origin)
+    for variable, level in dict.fromkeys(LAYERS):
+      if (variable, level) in layer_values:
+        open_store(f"{variable}_{level}hPa_{date}{STORE_EXTENSION}", f"{variable}_{level}hPa", labels,
+                   (1,) + layer_values[(variable, level)].shape, origin=origin)
+
+  for variable in dict.fromkeys(VARIABLES):
+    levels = volume_levels[variable]
+    if not levels:
+      print(f"No data found for {variable} between {MIN_LEVEL} and {MAX_LEVEL} hPa")
+      continue
+
+    # stack with the highest pressure (lowest altitude) at z = 0
+    volume_3d = np.stack([levels[level] for level in sorted(levels, reverse=True)])
+    output_filename = f"{variable}_{date}_{time:02d}.vti"
+    write_volume(volume_3d, variable, output_filename, VTI_ENCODING, origin)
+    outputs.append((variable, output_filename))
+    if VOLUME_STORE:
+      write_timestep(f"{variable}_{date}{STORE_EXTENSION}", variable, labels, time - START_TIME, volume_3d,
+                     origin=origin)
+
+  for variable, level in dict.fromkeys(LAYERS):
+    if (variable, level) not in layer_values:
+      print(f"No data found for {variable} at {level} hPa")
+      continue
+
+    output_filename = f"{variable}_{level}hPa_{date}_{time:02d}.vti"
+    write_layer(layer_values[(variable, level)], f"{variable}_{level}hPa", output_filename, VTI_ENCODING, origin)
+    outputs.append((f"{variable}_{level}hPa", output_filename))
+    if VOLUME_STORE:
+      write_timestep(f"{variable}_{level}hPa_{date}{STORE_EXTENSION}", f"{variable}_{level}hPa",
+                     labels, time - START_TIME, layer_values[(variable, level)][np.newaxis], origin=origin)
+  return outputs
+
+
+if __name__ == '__main__':
+  extract()
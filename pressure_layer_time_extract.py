@@ -1,10 +1,14 @@
 import numpy as np
 import pygrib
-import vtk
-from vtk.util.numpy_support import numpy_to_vtk
 import os
-import requests
-from herbie import Herbie
+from grib_fetch import download_subset
+from grib_cache import GribCache
+from ingest_pipeline import run_pipeline, watch
+from data_source import open_source
+from ingest_manifest import IngestManifest
+from volume_store import open_store, write_timestep, STORE_EXTENSION
+from vti_io import write_vti
+from grid_region import region_slices, region_origin
 import pandas as pd
 
 VARIABLE = "Geopotential height"
@@ -13,36 +17,87 @@ TARGET_LEVEL = 1000
 DATE = "2025-04-07"
 START_TIME = 0
 END_TIME = 5
+PIPELINE = True
+DOWNLOAD_WORKERS = 4
+CONVERT_WORKERS = 2
+VOLUME_STORE = True
+# see vti_io.py for the options, storage "float16"/"uint16" trade precision for space
+VTI_ENCODING = {"data_mode": "raw", "compressor": "zlib", "level": 5, "block_size": 32768, "storage": "float32"}
+CACHE_DIR = "grib_cache"
+CACHE_MAX_BYTES = 20 * 1024**3
+# only write part of the grid, e.g. {"x": (600, 1200), "y": (300, 800)} (grid indices)
+# or {"lat": (30, 45), "lon": (-105, -90)}, see grid_region.py; None writes everything
+REGION = None
+# finished outputs are recorded here with their size and checksum, reruns skip
+# them and only redo the hours that failed; None disables it
+MANIFEST_FILE = "ingest_manifest.json"
+# also compare checksums (not only sizes) of recorded outputs before skipping them
+MANIFEST_VERIFY = False
+# keep polling for hours that are not published yet and ingest each as it appears
+WATCH = False
+POLL_SECONDS = 300
+# a watched hour that fails this many times is given up on (and reported)
+WATCH_ATTEMPTS = 3
+# read the GRIB2 files from a local copy of the archive (e.g. an NFS mirror) instead of
+# downloading them, see data_source.py for the layout; None downloads
+SOURCE_DIR = None
+
+def available(date, time):
+  # whether the hour has been published (or is in SOURCE_DIR)
+  return open_source(SOURCE_DIR).available(pd.Timestamp(f"{date} {time}:00"))
+
+def download(date, time, file_name):
+  run_time = pd.Timestamp(f"{date} {time}:00")
+
+  # Download only the VARIABLE message at TARGET_LEVEL,
+  # messages already in the GRIB cache are not downloaded again
+  cache = GribCache(CACHE_DIR, CACHE_MAX_BYTES) if CACHE_DIR else None
+  download_subset(open_source(SOURCE_DIR), run_time, VARIABLE, TARGET_LEVEL, TARGET_LEVEL, file_name, cache, ("hrrr", "prs", run_time, 0))
 
 def extract():
   # Define the date
   date = DATE
-
-  for time in range(START_TIME, END_TIME):
-    run_time = pd.Timestamp(f"{date} {time}:00")
-    H = Herbie(run_time, model="hrrr", product="prs", fxx=0)
-
-    records = H.inventory("HGT")
-    print(records.head(10))  # Print first 10 records
-
-    # Get the remote GRIB2 file URL
-    grib_url = H.grib
-    print(grib_url)
-
-    # Stream the file to a temporary location
-    response = requests.get(grib_url, stream=True)
-    response.raise_for_status()
-
-    # Save the file locally
-    with open(GRIB_FILE_PATH, "wb") as f:
-      f.write(response.content)
-
-    # extract pressure layer geopotential height values
-    convert(GRIB_FILE_PATH, date, time)
-
-  os.remove(GRIB_FILE_PATH)
+  hours = [(date, time) for time in range(START_TIME, END_TIME)]
+
+  # hours whose outputs are all in the manifest are skipped, unless they were
+  # written with other settings (the same as multi_extract.py's for its layers)
+  settings = {"region": REGION, "encoding": VTI_ENCODING}
+  manifest = IngestManifest(MANIFEST_FILE, MANIFEST_VERIFY, settings) if MANIFEST_FILE else None
+  if manifest is not None:
+    hours = manifest.pending([f"{VARIABLE}_{TARGET_LEVEL}hPa"], hours)
+
+  if WATCH:
+    watch(hours, available, lambda ready: ingest(ready, manifest), POLL_SECONDS, WATCH_ATTEMPTS)
+  else:
+    ingest(hours, manifest)
+
+def ingest(hours, manifest):
+  # returns the hours that failed
+  on_converted = manifest.record if manifest is not None else None
+
+  # overlap downloads of later hours with decoding of earlier ones
+  if PIPELINE:
+    return run_pipeline(hours, download, convert, GRIB_FILE_PATH, DOWNLOAD_WORKERS, CONVERT_WORKERS, on_converted)
+
+  failed = []
+  for date, time in hours:
+    try:
+      download(date, time, GRIB_FILE_PATH)
+
+      # extract pressure layer geopotential height values
+      outputs = convert(GRIB_FILE_PATH, date, time)
+      if manifest is not None:
+        manifest.record(date, time, outputs)
+    except Exception as e:
+      print(f"Failed {date} {time:02d}:00: {e}")
+      failed.append((date, time))
+
+  if os.path.exists(GRIB_FILE_PATH):
+    os.remove(GRIB_FILE_PATH)
+  return failed
 
 def convert(file_name, date, time):
+  # returns the (output name, file name) written
   grbs = pygrib.open(file_name)
 
   # Get the layer for the target pressure level
@@ -51,31 +106,32 @@ def convert(file_name, date, time):
   except IndexError:
     print(f"No data found for {VARIABLE} at {TARGET_LEVEL} hPa")
     grbs.close()
-    return
+    return []
 
-  values_2d = target_grb.values.astype(np.float32)
+  rows, cols = region_slices(REGION, target_grb)
+  origin = region_origin(rows, cols)
+  values_2d = target_grb.values[rows, cols].astype(np.float32)
   grbs.close()
 
-  ny, nx = values_2d.shape
+  # the layer's time-series volume store (with nz = 1) must match this run before
+  # the .vti is written
+  labels = [f"{date}_{t:02d}" for t in range(START_TIME, END_TIME)]
+  store_name = f"{VARIABLE}_{TARGET_LEVEL}hPa_{date}{STORE_EXTENSION}"
+  if VOLUME_STORE:
+    open_store(store_name, f"{VARIABLE}_{TARGET_LEVEL}hPa", labels, (1,) + values_2d.shape, origin=origin)
 
-  # Create 2D vtkImageData with Z=1
-  image_data = vtk.vtkImageData()
-  image_data.SetDimensions(nx, ny, 1)
-  image_data.SetSpacing(1.0, 1.0, 1.0)
-  image_data.SetOrigin(0.0, 0.0, 0.0)
+  output_filename = f"{VARIABLE}_{TARGET_LEVEL}hPa_{date}_{time:02d}.vti"
+  write_layer(values_2d, f"{VARIABLE}_{TARGET_LEVEL}hPa", output_filename, VTI_ENCODING, origin)
 
-  # Flatten array and convert
-  flat_array = values_2d.ravel(order="C")
-  vtk_array = numpy_to_vtk(num_array=flat_array, deep=True, array_type=vtk.VTK_FLOAT)
-  vtk_array.SetName(f"{VARIABLE}_{TARGET_LEVEL}hPa")
-  image_data.GetPointData().SetScalars(vtk_array)
+  # Also add the hour to the layer's time-series volume store
+  if VOLUME_STORE:
+    write_timestep(store_name, f"{VARIABLE}_{TARGET_LEVEL}hPa", labels, time - START_TIME, values_2d[np.newaxis], origin=origin)
+  return [(f"{VARIABLE}_{TARGET_LEVEL}hPa", output_filename)]
 
-  # Write to .vti
-  output_filename = f"{VARIABLE}_{TARGET_LEVEL}hPa_{date}_{time:02d}.vti"
-  writer = vtk.vtkXMLImageDataWriter()
-  writer.SetFileName(output_filename)
-  writer.SetInputData(image_data)
-  writer.Write()
+
+def write_layer(values_2d, array_name, output_filename, encoding=None, origin=(0.0, 0.0, 0.0)):
+  # Create 2D vtkImageData with Z=1 and write to .vti
+  write_vti(values_2d[np.newaxis], array_name, output_filename, encoding, origin)
 
   print(f"Saved pressure layer: {output_filename}")
 
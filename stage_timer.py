@@ -0,0 +1,87 @@
+from collections import deque
+from contextlib import contextmanager
+import csv
+import json
+import os
+import threading
+import time
+import numpy as np
+
+'''
+Records how long each stage of loading, contouring and rendering takes, from
+any thread. Used for the on-screen statistics of atmosphere_vis.py and to
+export a trace of a session:
+  .json - Chrome trace event format (open in chrome://tracing or ui.perfetto.dev)
+  .csv  - one row per stage run: stage, start (s), duration (s), thread
+
+Usage:
+  from stage_timer import timer
+  with timer.stage("contour"):
+    ...
+'''
+
+class StageTimer:
+  def __init__(self, max_records=200000, window=100):
+    self.origin = time.perf_counter()
+    # (stage, start, duration, thread name), oldest dropped past max_records
+    self.records = deque(maxlen=max_records)
+    # per stage: number of runs and the durations of the last `window` runs
+    self.window = window
+    self.runs = {}
+    self.recent = {}
+    self.lock = threading.Lock()
+
+  @contextmanager
+  def stage(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(name, start, time.perf_counter() - start)
+
+  def record(self, name, start, duration, thread=None):
+    with self.lock:
+      self.records.append((name, start - self.origin, duration, thread or threading.current_thread().name))
+      self.runs[name] = self.runs.get(name, 0) + 1
+      self.recent.setdefault(name, deque(maxlen=self.window)).append(duration)
+
+  def summary(self):
+    # per stage: (runs, mean, 95th percentile, max) in seconds, over its recent runs
+    with self.lock:
+      recent = {name: (self.runs[name], np.array(durations)) for name, durations in self.recent.items()}
+    return {name: (runs, values.mean(), np.percentile(values, 95), values.max())
+            for name, (runs, values) in recent.items()}
+
+  def take(self):
+    # hand the records over (e.g. from a worker process), clearing them here
+    with self.lock:
+      records = list(self.records)
+      self.records.clear()
+    return [(name, start + self.origin, duration, thread) for name, start, duration, thread in records]
+
+  def merge(self, records, prefix=""):
+    # add records returned by take() in another process (perf_counter is system wide)
+    for name, start, duration, thread in records:
+      self.record(name, start, duration, prefix + thread)
+
+  def export(self, file_name):
+    with self.lock:
+      records = list(self.records)
+
+    if file_name.endswith(".csv"):
+      with open(file_name, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(["stage", "start_s", "duration_s", "thread"])
+        writer.writerows(records)
+    else:
+      threads = {}
+      events = [{"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                 "pid": os.getpid(), "tid": threads.setdefault(thread, len(threads))}
+                for name, start, duration, thread in records]
+      events += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": thread}}
+                 for thread, tid in threads.items()]
+      with open(file_name, "w") as output:
+        json.dump({"traceEvents": events}, output)
+    print(f"saved {len(records)} timings in {file_name}")
+
+timer = StageTimer()
@@ -0,0 +1,141 @@
+import argparse
+import os
+import time
+import numpy as np
+from vtk.util.numpy_support import vtk_to_numpy
+from vti_io import read_vti, write_vti
+from volume_store import VolumeStore, STORE_EXTENSION
+
+'''
+Compares the timesteps of a folder of hourly volumes (or a volume store) by
+streaming through them one at a time, writing one folder of .vti files per
+statistic that atmosphere_vis.py --folder1/--folder2 can open directly:
+  diff - hour-over-hour change, this hour minus the previous one (all zeros for
+         the first hour, so every folder has one file per hour of the input)
+  mean, min, max, std - running statistics of all hours so far (std is the
+         population standard deviation), the last file covers the whole period
+
+Memory stays the same however many timesteps there are: the statistics are
+online accumulators (Welford's algorithm for mean and std) updated in place,
+with one scratch and one output buffer reused for every hour. Only the current
+and previous volumes are loaded at a time.
+
+Usage: python temporal_stats.py --input <folder or .vstore> --output <folder>
+                                [--stats diff mean min max std] [--final]
+'''
+
+STATISTICS = ["diff", "mean", "min", "max", "std"]
+
+def read_timesteps(path):
+  # yields (label, float32 (nz, ny, nx) values, origin) of one timestep at a time
+  if path.endswith(STORE_EXTENSION):
+    store = VolumeStore(path)
+    for index, label in enumerate(store.labels):
+      if store.written[index]:
+        yield f"{store.name}_{label}", store.volumes[index], tuple(store.meta["origin"])
+  else:
+    for file in sorted(os.listdir(path)):
+      if file.endswith(".vti"):
+        image_data = read_vti(os.path.join(path, file))
+        nx, ny, nz = image_data.GetDimensions()
+        values = vtk_to_numpy(image_data.GetPointData().GetScalars()).reshape(nz, ny, nx)
+        yield os.path.splitext(file)[0], values, image_data.GetOrigin()
+
+class RunningStats:
+  # count, mean, M2 (sum of squared differences from the mean), min and max of the
+  # volumes added so far, only the accumulators the statistics need are allocated
+  def __init__(self, shape, statistics):
+    self.shape = shape
+    self.count = 0
+    wanted = set(statistics)
+    self.mean = np.zeros(shape, dtype=np.float32) if wanted & {"mean", "std"} else None
+    self.m2 = np.zeros(shape, dtype=np.float32) if "std" in wanted else None
+    self.min = np.zeros(shape, dtype=np.float32) if "min" in wanted else None
+    self.max = np.zeros(shape, dtype=np.float32) if "max" in wanted else None
+    self.delta = np.empty(shape, dtype=np.float32) if self.mean is not None else None
+
+  def add(self, values):
+    self.count += 1
+    if self.count == 1:
+      for accumulator in (self.mean, self.min, self.max):
+        if accumulator is not None:
+          accumulator[:] = values
+      return
+
+    if self.min is not None:
+      np.minimum(self.min, values, out=self.min)
+    if self.max is not None:
+      np.maximum(self.max, values, out=self.max)
+    if self.mean is not None:
+      # delta = (x - old mean) / n, mean += delta, M2 += (x - old mean) * (x - new mean),
+      # which is delta^2 * n * (n - 1)
+      n = self.count
+      np.subtract(values, self.mean, out=self.delta)
+      np.multiply(self.delta, np.float32(1.0 / n), out=self.delta)
+      self.mean += self.delta
+      if self.m2 is not None:
+        np.multiply(self.delta, self.delta, out=self.delta)
+        self.delta *= np.float32(n * (n - 1))
+        self.m2 += self.delta
+
+  def std(self, out):
+    np.divide(self.m2, np.float32(self.count), out=out)
+    return np.sqrt(out, out=out)
+
+def temporal_stats(path, output, statistics, final_only=False):
+  folders = {statistic: os.path.join(output, statistic) for statistic in statistics}
+  for folder in folders.values():
+    os.makedirs(folder, exist_ok=True)
+
+  def write(values, statistic, label, origin):
+    file_name = os.path.join(folders[statistic], f"{label}_{statistic}.vti")
+    write_vti(values, statistic, file_name, origin=origin)
+    print(f"Saved {file_name}")
+
+  def write_running(label, origin):
+    for statistic in ("mean", "min", "max"):
+      if statistic in statistics:
+        write(getattr(stats, statistic), statistic, label, origin)
+    if "std" in statistics:
+      write(stats.std(out), "std", label, origin)
+
+  stats = None
+  out = None
+  previous = None
+  label = origin = None
+  start = time.perf_counter()
+  for label, values, origin in read_timesteps(path):
+    if stats is None:
+      stats = RunningStats(values.shape, statistics)
+      if "diff" in statistics or "std" in statistics:
+        out = np.empty(values.shape, dtype=np.float32)
+    elif values.shape != stats.shape:
+      raise ValueError(f"{label} has shape {values.shape}, the earlier timesteps {stats.shape}")
+
+    stats.add(values)
+    if "diff" in statistics:
+      if previous is None:
+        out[:] = 0
+      else:
+        np.subtract(values, previous, out=out)
+      write(out, "diff", label, origin)
+      previous = values
+
+    if not final_only:
+      write_running(label, origin)
+
+  if stats is None:
+    raise ValueError(f"No timesteps in {path}")
+  if final_only:
+    write_running(label, origin)
+  print(f"{stats.count} timesteps in {time.perf_counter() - start:.1f} s")
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--input', type=str, required=True, help='folder of .vti volumes (one per hour) or .vstore file')
+  parser.add_argument('--output', type=str, required=True, help='folder the statistics folders are written to')
+  parser.add_argument('--stats', type=str, nargs='+', default=STATISTICS, choices=STATISTICS, help='statistics to write')
+  parser.add_argument('--final', action='store_true', help='only write mean/min/max/std of the whole period, not after every hour')
+  args = parser.parse_args()
+
+  temporal_stats(args.input, args.output, args.stats, args.final)
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+import itertools
+import queue
+import threading
+
+'''
+Lazily computed per-timestep results (e.g. isosurfaces) kept in an LRU cache
+with a memory budget. Results are computed on a background thread: the
+timestep being shown first, then its neighbours ahead of time so scrubbing
+stays smooth. When the inputs change (e.g. a new isovalue) invalidate()
+drops the cached results and recomputes them, nearest to the shown timestep
+first, and any job queued for the old inputs is skipped.
+
+A timestep whose background compute raises is marked failed (error() returns
+the exception) and is not tried again until the inputs change.
+'''
+
+class TimestepCache:
+  def __init__(self, num_timesteps, compute, size_of, max_bytes, prefetch_radius=2, on_ready=None, on_failed=None):
+    # compute(index) builds the result for a timestep, size_of(result) is its size in bytes,
+    # on_ready(index, result) is called from the background thread when a result is done,
+    # on_failed(index, exception) when computing it raised
+    self.num_timesteps = num_timesteps
+    self.compute = compute
+    self.size_of = size_of
+    self.max_bytes = max_bytes
+    self.prefetch_radius = prefetch_radius
+    self.on_ready = on_ready
+    self.on_failed = on_failed
+
+    self.entries = OrderedDict()
+    self.failed = {}
+    self.total_bytes = 0
+    self.current = 0
+    self.generation = 0
+    self.lock = threading.Lock()
+
+    # jobs are (priority, order, index, generation, is_prefetch), lowest priority first
+    self.jobs = queue.PriorityQueue()
+    self.order = itertools.count()
+    self.queued = set()
+    self.running = {}
+    self.worker = threading.Thread(target=self._work, daemon=True)
+    self.worker.start()
+
+  def __len__(self):
+    return self.num_timesteps
+
+  def get(self, index):
+    # blocking: returns the result, computing it on this thread if needed
+    with self.lock:
+      self.current = index
+      if index in self.entries:
+        self.entries.move_to_end(index)
+        return self.entries[index][0]
+      running = self.running.get(index)
+      generation = self.generation
+
+    # already being computed in the background, wait for it instead of computing it twice
+    if running is not None:
+      running.wait()
+      with self.lock:
+        if index in self.entries:
+          return self.entries[index][0]
+
+    value = self.compute(index)
+    self._put(index, value, generation)
+    return value
+
+  def peek(self, index):
+    # non-blocking: returns the cached result or None
+    with self.lock:
+      self.current = index
+      if index in self.entries:
+        self.entries.move_to_end(index)
+        return self.entries[index][0]
+      return None
+
+  def error(self, index):
+    # the exception computing a timestep raised in the background, None if it didn't fail
+    with self.lock:
+      return self.failed.get(index)
+
+  def request(self, index):
+    # compute a timestep in the background ahead of any prefetching,
+    # on_ready is called once it is done
+    self._submit(index, 0, False)
+
+  def prefetch(self, index):
+    # t+1, t-1, t+2, t-2, ...
+    for distance in range(1, self.prefetch_radius + 1):
+      for neighbor in (index + distance, index - distance):
+        if 0 <= neighbor < self.num_timesteps:
+          self._submit(neighbor, distance, True)
+
+  def invalidate(self):
+    # the inputs changed: recompute the timestep being shown, then every other
+    # timestep that was cached (or still being computed), nearest first
+    with self.lock:
+      cached = set(self.entries) | set(self.running)
+      cached.update(index for index, generation in self.queued if generation == self.generation)
+      self.generation += 1
+      self.entries.clear()
+      self.failed.clear()
+      self.total_bytes = 0
+      current = self.current
+
+    self._submit(current, 0, False)
+    for index in sorted(cached, key=lambda index: abs(index - current)):
+      self._submit(index, 1 + abs(index - current), False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.failed.clear()
+      self.total_bytes = 0
+
+  def _submit(self, index, priority, is_prefetch):
+    with self.lock:
+      if index in self.entries or index in self.failed or (index, self.generation) in self.queued:
+        return
+      self.queued.add((index, self.generation))
+      self.jobs.put((priority, next(self.order), index, self.generation, is_prefetch))
+
+  def _work(self):
+    while True:
+      _, _, index, generation, is_prefetch = self.jobs.get()
+
+      with self.lock:
+        self.queued.discard((index, generation))
+        # skip jobs for old inputs, finished timesteps and prefetches
+        # of timesteps the user has already scrubbed away from
+        if (generation != self.generation or index in self.entries
+            or (is_prefetch and abs(index - self.current) > self.prefetch_radius)):
+          continue
+        done = threading.Event()
+        self.running[index] = done
+
+      try:
+        value = self.compute(index)
+      except Exception as e:
+        print(f"Error computing timestep {index}: {e}")
+        with self.lock:
+          self.running.pop(index, None)
+          # failures for inputs that have changed since don't count
+          failed = generation == self.generation
+          if failed:
+            self.failed[index] = e
+        done.set()
+        if failed and self.on_failed is not None:
+          self.on_failed(index, e)
+        continue
+
+      with self.lock:
+        self.running.pop(index, None)
+      done.set()
+
+      if value is not None and self._put(index, value, generation) and self.on_ready is not None:
+        self.on_ready(index, value)
+
+  def _put(self, index, value, generation):
+    size = self.size_of(value)
+    with self.lock:
+      # computed for inputs that have changed since
+      if generation != self.generation:
+        return False
+      if index not in self.entries:
+        self.entries[index] = (value, size)
+        self.total_bytes += size
+
+      # evict least recently used timesteps, but always keep the newest one
+      while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+        _, (_, evicted_size) = self.entries.popitem(last=False)
+        self.total_bytes -= evicted_size
+      return True
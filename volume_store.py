@@ -0,0 +1,119 @@
+import json
+import os
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+
+'''
+Time-series volume store: one file per variable holding every timestep as a
+contiguous (nt, nz, ny, nx) float32 array behind a small header.
+
+  bytes 0-7        magic b"HRRRVOL1"
+  bytes 8-15       length of the JSON metadata (little endian uint64)
+  JSON metadata    name, shape, spacing, origin and a label for every timestep
+  nt bytes         1 if a timestep has been written, 0 otherwise
+  padding          up to the next page boundary
+  data             the (nt, nz, ny, nx) array
+
+The viewer opens it with numpy.memmap, so loading a timestep doesn't read or
+copy anything and the page cache is shared between viewer instances.
+'''
+
+STORE_EXTENSION = ".vstore"
+MAGIC = b"HRRRVOL1"
+PAGE_SIZE = 4096
+
+def _layout(meta):
+  header = json.dumps(meta).encode()
+  flags_offset = len(MAGIC) + 8 + len(header)
+  data_offset = -(-(flags_offset + meta["shape"][0]) // PAGE_SIZE) * PAGE_SIZE
+  return header, flags_offset, data_offset
+
+def create_store(file_name, name, labels, shape, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
+  # shape is the (nz, ny, nx) of one timestep
+  meta = {
+    "name": name,
+    "shape": [len(labels)] + [int(n) for n in shape],
+    "dtype": "float32",
+    "spacing": list(spacing),
+    "origin": list(origin),
+    "labels": list(labels),
+  }
+  header, flags_offset, data_offset = _layout(meta)
+  data_size = int(np.prod(meta["shape"])) * np.dtype(np.float32).itemsize
+
+  # build the file under a temporary name and link it into place, so several
+  # ingest processes can race to create the same store safely
+  temp_name = f"{file_name}.{os.getpid()}.part"
+  with open(temp_name, "wb") as f:
+    f.write(MAGIC)
+    f.write(len(header).to_bytes(8, "little"))
+    f.write(header)
+    f.truncate(data_offset + data_size)
+  try:
+    os.link(temp_name, file_name)
+  except FileExistsError:
+    pass
+  finally:
+    os.remove(temp_name)
+
+def read_meta(file_name):
+  with open(file_name, "rb") as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f"{file_name} is not a volume store")
+    header_length = int.from_bytes(f.read(8), "little")
+    return json.loads(f.read(header_length))
+
+def open_store(file_name, name, labels, shape, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
+  # creates the store on first use, otherwise checks that it holds the same timesteps,
+  # grid and placement, returns its metadata. The extract scripts call it before
+  # writing an hour's .vti, so a mismatch fails before any output is written
+  if not os.path.exists(file_name):
+    create_store(file_name, name, labels, shape, spacing, origin)
+
+  meta = read_meta(file_name)
+  if (meta["shape"][1:] != [int(n) for n in shape] or meta["labels"] != list(labels)
+      or not np.allclose(meta["origin"], origin) or not np.allclose(meta["spacing"], spacing)):
+    raise ValueError(f"{file_name} holds {meta['shape']} at origin {meta['origin']} for {meta['labels']}, "
+                     f"not {[len(labels)] + list(shape)} at {list(origin)}, remove it to start a new store")
+  return meta
+
+def write_timestep(file_name, name, labels, index, volume_3d, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
+  # every timestep is written in place
+  meta = open_store(file_name, name, labels, volume_3d.shape, spacing, origin)
+
+  _, flags_offset, data_offset = _layout(meta)
+  volumes = np.memmap(file_name, dtype=np.float32, mode="r+", offset=data_offset, shape=tuple(meta["shape"]))
+  volumes[index] = volume_3d
+  volumes.flush()
+  del volumes
+
+  with open(file_name, "r+b") as f:
+    f.seek(flags_offset + index)
+    f.write(b"\x01")
+
+  print(f"Stored {name} timestep {labels[index]} in '{file_name}'")
+
+class VolumeStore:
+  def __init__(self, file_name):
+    self.file_name = file_name
+    self.meta = read_meta(file_name)
+    self.name = self.meta["name"]
+    self.labels = self.meta["labels"]
+
+    _, flags_offset, data_offset = _layout(self.meta)
+    self.written = np.fromfile(file_name, dtype=np.uint8, count=len(self.labels), offset=flags_offset).astype(bool)
+    self.volumes = np.memmap(file_name, dtype=np.float32, mode="r", offset=data_offset, shape=tuple(self.meta["shape"]))
+
+  def image_data(self, index):
+    # wrap one timestep of the memmap as vtkImageData without copying it
+    nz, ny, nx = self.volumes.shape[1:]
+    image_data = vtk.vtkImageData()
+    image_data.SetDimensions(nx, ny, nz)
+    image_data.SetSpacing(self.meta["spacing"])
+    image_data.SetOrigin(self.meta["origin"])
+
+    vtk_array = numpy_to_vtk(num_array=self.volumes[index].reshape(-1), deep=False, array_type=vtk.VTK_FLOAT)
+    vtk_array.SetName(self.name)
+    image_data.GetPointData().SetScalars(vtk_array)
+    return image_data
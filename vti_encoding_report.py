@@ -0,0 +1,64 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from vtk.util.numpy_support import vtk_to_numpy
+from vti_io import write_vti, read_vti
+
+'''
+Writes one .vti volume with each encoding setting and reports the bytes on
+disk, write time, read time (including dequantizing) and the largest error
+that the lossy storage formats introduce.
+
+Usage: python vti_encoding_report.py [--file <.vti file>] [--repeat <n>]
+'''
+
+SETTINGS = [
+  ("base64 zlib (VTK default)", {"data_mode": "base64", "compressor": "zlib", "level": 5}),
+  ("raw none", {"data_mode": "raw", "compressor": None}),
+  ("raw zlib 1", {"data_mode": "raw", "compressor": "zlib", "level": 1}),
+  ("raw zlib 5", {"data_mode": "raw", "compressor": "zlib", "level": 5}),
+  ("raw zlib 5 1MB blocks", {"data_mode": "raw", "compressor": "zlib", "level": 5, "block_size": 1 << 20}),
+  ("raw lz4", {"data_mode": "raw", "compressor": "lz4", "level": 5}),
+  ("raw lzma 5", {"data_mode": "raw", "compressor": "lzma", "level": 5}),
+  ("inline zlib 5", {"data_mode": "inline", "compressor": "zlib", "level": 5}),
+  ("raw zlib 5 float16", {"data_mode": "raw", "compressor": "zlib", "level": 5, "storage": "float16"}),
+  ("raw zlib 5 uint16", {"data_mode": "raw", "compressor": "zlib", "level": 5, "storage": "uint16"}),
+  ("raw lz4 uint16", {"data_mode": "raw", "compressor": "lz4", "level": 5, "storage": "uint16"}),
+]
+
+def report(file_name, repeat):
+  image_data = read_vti(file_name)
+  nx, ny, nz = image_data.GetDimensions()
+  scalars = image_data.GetPointData().GetScalars()
+  values = vtk_to_numpy(scalars).reshape(nz, ny, nx)
+  print(f"{file_name}: {nx} x {ny} x {nz}, {values.nbytes / 1e6:.1f} MB as float32\n")
+
+  print(f"{'setting':<28}{'MB on disk':>12}{'write s':>10}{'read s':>10}{'max error':>12}")
+  with tempfile.TemporaryDirectory() as temp_dir:
+    for label, encoding in SETTINGS:
+      out_name = os.path.join(temp_dir, "volume.vti")
+
+      start = time.perf_counter()
+      write_vti(values, scalars.GetName(), out_name, encoding)
+      write_time = time.perf_counter() - start
+
+      read_times = []
+      for _ in range(repeat):
+        start = time.perf_counter()
+        loaded = read_vti(out_name)
+        read_times.append(time.perf_counter() - start)
+
+      error = np.abs(vtk_to_numpy(loaded.GetPointData().GetScalars()).reshape(nz, ny, nx) - values).max()
+      size = os.path.getsize(out_name)
+      print(f"{label:<28}{size / 1e6:>12.1f}{write_time:>10.2f}{min(read_times):>10.2f}{error:>12.3g}")
+      os.remove(out_name)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--file', type=str, default="clm_2025-04-08/Cloud mixing ratio_2025-04-08_01.vti", help='.vti volume to re-encode')
+  parser.add_argument('--repeat', type=int, default=3, help='number of reads to take the best time of')
+  args = parser.parse_args()
+
+  report(args.file, args.repeat)
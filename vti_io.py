@@ -0,0 +1,130 @@
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+'''
+Helper functions to write .vti files with a configurable encoding and to read
+them back, undoing any lossy storage format
+
+Encoding options (any key left out falls back to DEFAULT_ENCODING):
+  data_mode   - "raw" (appended raw bytes), "base64" (appended, base64 encoded)
+                or "inline" (base64 inside each DataArray element)
+  compressor  - None, "zlib", "lz4" or "lzma"
+  level       - compression level (1-9)
+  block_size  - size in bytes of the blocks that are compressed independently
+  storage     - "float32", "float16" (half precision) or "uint16" (values
+                quantized between the array's min and max with an offset/scale)
+'''
+
+DEFAULT_ENCODING = {
+  "data_mode": "raw",
+  "compressor": "zlib",
+  "level": 5,
+  "block_size": 32768,
+  "storage": "float32",
+}
+
+COMPRESSORS = {
+  None: vtk.vtkXMLWriter.NONE,
+  "zlib": vtk.vtkXMLWriter.ZLIB,
+  "lz4": vtk.vtkXMLWriter.LZ4,
+  "lzma": vtk.vtkXMLWriter.LZMA,
+}
+
+# field data arrays describing how the scalars were stored
+STORAGE_ARRAY = "storage"
+QUANTIZATION_ARRAY = "quantization"
+
+def make_image_data(values_3d, name, storage="float32", origin=(0.0, 0.0, 0.0)):
+  nz, ny, nx = values_3d.shape
+
+  image_data = vtk.vtkImageData()
+  image_data.SetDimensions(nx, ny, nz)
+  image_data.SetSpacing(1.0, 1.0, 1.0)
+  image_data.SetOrigin(origin)
+
+  values_flat = values_3d.ravel(order="C")
+  if storage == "float32":
+    # wrap the array without copying it, it only has to live until it is written
+    vtk_array = numpy_to_vtk(num_array=values_flat, deep=False, array_type=vtk.VTK_FLOAT)
+  elif storage == "float16":
+    # VTK has no half precision type, so the float16 bits go in an unsigned short array
+    half_bits = values_flat.astype(np.float16).view(np.uint16)
+    vtk_array = numpy_to_vtk(num_array=half_bits, deep=True, array_type=vtk.VTK_UNSIGNED_SHORT)
+  elif storage == "uint16":
+    offset = float(values_flat.min())
+    scale = (float(values_flat.max()) - offset) / 65535.0 or 1.0
+    quantized = np.rint((values_flat - offset) / scale).astype(np.uint16)
+    vtk_array = numpy_to_vtk(num_array=quantized, deep=True, array_type=vtk.VTK_UNSIGNED_SHORT)
+
+    quantization = vtk.vtkDoubleArray()
+    quantization.SetName(QUANTIZATION_ARRAY)
+    quantization.InsertNextValue(offset)
+    quantization.InsertNextValue(scale)
+    image_data.GetFieldData().AddArray(quantization)
+  else:
+    raise ValueError(f"Unknown storage '{storage}', expected float32, float16 or uint16")
+
+  if storage != "float32":
+    storage_array = vtk.vtkStringArray()
+    storage_array.SetName(STORAGE_ARRAY)
+    storage_array.InsertNextValue(storage)
+    image_data.GetFieldData().AddArray(storage_array)
+
+  vtk_array.SetName(name)
+  image_data.GetPointData().SetScalars(vtk_array)
+  return image_data
+
+def write_vti(values_3d, name, file_name, encoding=None, origin=(0.0, 0.0, 0.0)):
+  encoding = {**DEFAULT_ENCODING, **(encoding or {})}
+  image_data = make_image_data(values_3d, name, encoding["storage"], origin)
+
+  writer = vtk.vtkXMLImageDataWriter()
+  writer.SetFileName(file_name)
+  writer.SetInputData(image_data)
+
+  if encoding["data_mode"] == "inline":
+    writer.SetDataModeToBinary()
+  elif encoding["data_mode"] in ("raw", "base64"):
+    writer.SetDataModeToAppended()
+    writer.SetEncodeAppendedData(encoding["data_mode"] == "base64")
+  else:
+    raise ValueError(f"Unknown data mode '{encoding['data_mode']}', expected raw, base64 or inline")
+
+  writer.SetCompressorType(COMPRESSORS[encoding["compressor"]])
+  if encoding["compressor"] is not None:
+    writer.SetCompressionLevel(encoding["level"])
+  writer.SetBlockSize(encoding["block_size"])
+  # 32 bit block headers overflow for uncompressed volumes past 4 GB
+  writer.SetHeaderTypeToUInt64()
+  writer.Write()
+
+def dequantize(image_data):
+  # turn float16/uint16 scalars back into float32, in place
+  field_data = image_data.GetFieldData()
+  storage_array = field_data.GetAbstractArray(STORAGE_ARRAY)
+  if storage_array is None:
+    return image_data
+
+  storage = storage_array.GetValue(0)
+  scalars = image_data.GetPointData().GetScalars()
+  stored = vtk_to_numpy(scalars)
+  if storage == "float16":
+    values = stored.view(np.float16).astype(np.float32)
+  else:
+    quantization = field_data.GetArray(QUANTIZATION_ARRAY)
+    offset, scale = quantization.GetValue(0), quantization.GetValue(1)
+    values = (stored * np.float32(scale) + np.float32(offset)).astype(np.float32)
+
+  vtk_array = numpy_to_vtk(num_array=values, deep=True, array_type=vtk.VTK_FLOAT)
+  vtk_array.SetName(scalars.GetName())
+  image_data.GetPointData().SetScalars(vtk_array)
+  field_data.RemoveArray(STORAGE_ARRAY)
+  field_data.RemoveArray(QUANTIZATION_ARRAY)
+  return image_data
+
+def read_vti(file_name):
+  reader = vtk.vtkXMLImageDataReader()
+  reader.SetFileName(file_name)
+  reader.Update()
+  return dequantize(reader.GetOutput())